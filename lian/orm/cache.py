@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+Query result cache of BASE reads
+
+Entries are keyed on (table, table version, SQL), a write to the table bumps its version, so the entries
+of the previous version are never hit again, and are evicted by LRU (memory) or TTL (redis).
+
+    class Country(BASE):
+        __cache__ = {'ttl': 30, 'max_entries': 10000}  # 'backend': 'memory' / 'redis' / a backend object
+"""
+
+from __future__ import absolute_import, print_function
+
+import base64
+import collections
+import copy
+import hashlib
+import logging
+import pickle
+import threading
+import time
+
+DEFAULT_TTL = 30  # seconds
+DEFAULT_MAX_ENTRIES = 10000
+REDIS_PREFIX = 'lian:orm:cache:'
+
+LOG = logging.getLogger(__name__)
+
+
+class MemoryBackend(object):
+    """In-process LRU, the table versions are shared by all the memory backends of the process"""
+
+    _versions = {}
+    _versions_lock = threading.Lock()
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key => (expired_at, value)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def version(self, table):
+        return self._versions.get(table, 0)
+
+    def bump(self, table):
+        with self._versions_lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend(object):
+    """Shared by the workers, values are pickled
+
+    :param redis: a ``lian.redis.Redis`` or ``redis.StrictRedis``, default to ``lian.redis.Redis.instance()``
+    """
+
+    def __init__(self, redis=None, prefix=REDIS_PREFIX):
+        if redis is None:
+            from lian.redis import Redis
+            redis = Redis.instance()
+        self.redis = getattr(redis, 'redis', redis)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(base64.b64decode(value))
+
+    def set(self, key, value, ttl):
+        self.redis.set(self.prefix + key, base64.b64encode(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), ttl)
+
+    def version(self, table):
+        return int(self.redis.get(self.prefix + 'version:' + table) or 0)
+
+    def bump(self, table):
+        self.redis.incr(self.prefix + 'version:' + table)
+
+
+class QueryCache(object):
+    """Rows of the SQL reading one table, the rows got are shallow copies, safe to modify"""
+
+    def __init__(self, table, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, backend='memory'):
+        self.table = table
+        self.ttl = ttl
+        if backend == 'memory':
+            backend = MemoryBackend(max_entries)
+        elif backend == 'redis':
+            backend = RedisBackend()
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, sql):
+        """Look up before querying, so that rows read across a write are stored under the outdated version
+
+        :return: (key, rows or None)
+        """
+        digest = hashlib.sha1(sql.encode('utf-8')).hexdigest()
+        key = '%s:%s:%s' % (self.table, self.backend.version(self.table), digest)
+        rows = self.backend.get(key)
+        if rows is None:
+            self.misses += 1
+            return key, None
+        self.hits += 1
+        return key, [copy.copy(row) for row in rows]
+
+    def store(self, key, rows):
+        self.backend.set(key, [copy.copy(row) for row in rows], self.ttl)
+
+    def invalidate(self):
+        self.backend.bump(self.table)
@@ -15,24 +15,71 @@ max_allowed_packet=16*1024*1024, defer_connect=False,
 auth_plugin_map=None, read_timeout=None, write_timeout=None,
 bind_address=None, binary_prefix=False, program_name=None,
 server_public_key=None
+
+Pool options (CamelCase keys of the db config, not passed to pymysql)
+
+MaxConnections=5, AcquireTimeout=None, Logger=None,
+PingInterval=30, ValidateInterval=None,
+MinIdle=1, MaxIdle=MaxConnections, MaxLifetime=None, IdleTimeout=None,
+AsyncWorkers=MaxConnections, SlowQueryMs=1000, CoalesceReads=False,
+Replicas=None, ReplicaBalance='round-robin', ReadYourWrites=0
+
+CoalesceReads: concurrent ``query`` calls of the same SQL share one execution, see ``ConnectionPool.coalesce``
+
+Replicas: configs of the read replicas, overriding the primary config, e.g. [{'host': 'replica1'}, ...],
+          the reads (query, BASE.select/count/get...) go to a replica, except in a transaction, or in the
+          ``ReadYourWrites`` seconds after a write in the same context (thread / coroutine)
+ReplicaBalance: round-robin or least-using
 """
 
 from __future__ import absolute_import, print_function
 
+import asyncio
+import base64
+import collections
+import contextlib
+import contextvars
 import copy
+import datetime
+import decimal
+import functools
+import itertools
+import json
 import logging
 import threading
 import time
-import uuid
 
 import pymysql
-from six.moves.queue import Queue
+from pymysql.constants import CLIENT
+from concurrent.futures import ThreadPoolExecutor
 
+from lian.orm import cache as query_cache
+from lian.orm import loader
+from lian.orm import rows as row_formats
 from lian.orm import statement
+from lian.orm import stats as statement_stats
+from lian.orm import trace
+from lian.orm.nodes import escaped_str, has_subquery, literal, quote_field
+from lian.orm.shard import ModuloRouter, merge_rows
 from lian.utils.naming import camel2underline
 
 DEFAULT_DB = 'default'
 DEFAULT_CONNECTIONS = 5
+DEFAULT_ACQUIRE_TIMEOUT = None  # seconds, None: wait forever
+DEFAULT_PING_INTERVAL = 30  # seconds, ping a connection on acquire only if it was idle longer than that
+DEFAULT_VALIDATE_INTERVAL = None  # seconds, None: no background validation
+DEFAULT_MIN_IDLE = 1  # connections built at startup and kept by the maintainer
+DEFAULT_MAX_LIFETIME = None  # seconds, None: connections are never recycled for their age
+DEFAULT_IDLE_TIMEOUT = None  # seconds, None: idle connections are never reaped
+REPLICA_BALANCES = 'round-robin', 'least-using'
+DEFAULT_SLOW_QUERY_MS = 1000  # SQL slower than that are logged as warning
+MAINTAIN_INTERVAL = 1  # seconds
+IN_TEMP_TABLE = '_lian_in_keys'  # temporary table of the keys of a long IN list, see BASE.__in_temp_table_size__
+CONNECTION_ERRORS = (
+    2006,  # CR_SERVER_GONE_ERROR
+    2013,  # CR_SERVER_LOST
+    2055,  # CR_SERVER_LOST_EXTENDED
+)
 DEFAULT_CONFIG = {
     'host': 'localhost',
     'user': 'root',
@@ -43,6 +90,10 @@ DEFAULT_CONFIG = {
 LOG = logging.getLogger(__name__)
 
 
+class PoolExhausted(Exception):
+    pass
+
+
 class PooledConnection(object):
     def __init__(self, pool, db, connection):
         self._connection = connection
@@ -56,6 +107,10 @@ class PooledConnection(object):
                 self._pool.release(self._connection, self._db)
             self._connection = None
 
+    def detach(self):
+        # The connection was given back by its owner, forget it without releasing.
+        self._connection = None
+
     def __getattr__(self, name):
         # All other members are the same.
         return getattr(self._connection, name)
@@ -68,12 +123,118 @@ def init(config):
     ConnectionPool.init(config)
 
 
+def is_connection_error(error):
+    if isinstance(error, pymysql.err.InterfaceError):
+        return True
+    return isinstance(error, pymysql.err.OperationalError) and bool(error.args) and error.args[0] in CONNECTION_ERRORS
+
+
+def is_unsent_error(error):
+    """The connection was found broken before the statement was sent, so it was not applied by the server"""
+    if isinstance(error, pymysql.err.InterfaceError):
+        return True
+    return isinstance(error, pymysql.err.OperationalError) and bool(error.args) and error.args[0] == 2006
+
+
+class _ConnectionInfo(object):
+    __slots__ = ('created_at', 'released_at', 'validated')
+
+    def __init__(self):
+        self.created_at = self.released_at = time.time()
+        self.validated = True  # pinged (or connected) on the latest checkout
+
+
+class _Waiter(object):
+    __slots__ = ('condition', 'connection', 'granted')
+
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.connection = None  # a connection handed over by release()
+        self.granted = False  # a free slot to build a new connection
+
+
+class _Flight(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _PoolState(object):
+    """Connections book-keeping of one database, all members are protected by ``lock``."""
+
+    def __init__(self, max_connections, acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT, ping_interval=DEFAULT_PING_INTERVAL,
+                 validate_interval=DEFAULT_VALIDATE_INTERVAL, min_idle=DEFAULT_MIN_IDLE, max_idle=None,
+                 max_lifetime=DEFAULT_MAX_LIFETIME, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 slow_query_ms=DEFAULT_SLOW_QUERY_MS, coalesce_reads=False):
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.ping_interval = ping_interval
+        self.validate_interval = validate_interval
+        self.min_idle = min_idle
+        self.max_idle = max_connections if max_idle is None else max_idle
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self.slow_query_ms = slow_query_ms
+        self.coalesce_reads = coalesce_reads
+        self.lock = threading.Lock()
+        self.idle = collections.deque()
+        self.using = {}  # id(conn) => conn
+        self.infos = {}  # id(conn) => _ConnectionInfo, of every connection of the pool
+        self.waiters = collections.deque()
+        self.size = 0  # idle + using + connecting
+        self.flights = {}  # key => _Flight, the executions in progress shared by the concurrent callers
+        self.stats = {
+            'acquired': 0,
+            'waited': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'pings': 0,
+            'discarded': 0,
+            'retired': 0,
+            'coalesced': 0,
+        }
+
+    @property
+    def need_maintenance(self):
+        return bool(self.validate_interval or self.max_lifetime or self.idle_timeout)
+
+    def is_expired(self, conn, now):
+        return bool(self.max_lifetime) and now - self.infos[id(conn)].created_at > self.max_lifetime
+
+    def put_back(self, conn):
+        """Hand the connection over to the first waiter (FIFO), or put it into the idle queue."""
+        self.infos[id(conn)].released_at = time.time()
+        if self.waiters:
+            waiter = self.waiters.popleft()
+            waiter.connection = conn
+            waiter.condition.notify()
+        else:
+            self.idle.append(conn)
+
+    def free_slot(self):
+        self.size -= 1
+        if self.waiters:
+            waiter = self.waiters.popleft()
+            waiter.granted = True
+            self.size += 1
+            waiter.condition.notify()
+
+
+_last_writes = contextvars.ContextVar('lian.orm.db.last_writes', default={})  # real db => timestamp
+
+
 class ConnectionPool(object):
     _instance_lock = threading.Lock()
 
     _config = {}
     _logger = None
     _default_db = DEFAULT_DB
+    _replicas = {}  # db => names of the replicas in _config
+    _read_policies = {}  # db => (replica balance, read-your-writes seconds)
 
     @classmethod
     def init(cls, config):
@@ -94,7 +255,26 @@ class ConnectionPool(object):
             LOG.debug('All databases: %r', list(config.keys()))
             LOG.info('The database config has not DEFAULT_DB, choose %s as default database', cls._default_db)
 
-        cls._config = config
+        cls._replicas = {}
+        cls._read_policies = {}
+        all_config = dict(config)
+        for db, db_config in config.items():
+            replicas = db_config.pop('Replicas', None)
+            balance = db_config.pop('ReplicaBalance', REPLICA_BALANCES[0])
+            read_your_writes = db_config.pop('ReadYourWrites', 0)
+            if not replicas:
+                continue
+            assert isinstance(replicas, (list, tuple)) and all(isinstance(i, dict) for i in replicas)
+            assert balance in REPLICA_BALANCES, 'ReplicaBalance should be one of %r' % (REPLICA_BALANCES,)
+            assert read_your_writes >= 0
+            cls._replicas[db] = []
+            cls._read_policies[db] = (balance, read_your_writes)
+            for i, replica in enumerate(replicas):
+                name = '%s:replica%d' % (db, i)
+                all_config[name] = dict(db_config, **replica)
+                cls._replicas[db].append(name)
+
+        cls._config = all_config
 
     @classmethod
     def is_inited(cls):
@@ -122,20 +302,41 @@ class ConnectionPool(object):
     def get_logger(self, db=None):
         return self._loggers.get(self.real_db(db), self._logger)
 
-    def get_queue(self, db=None):
-        return self._queues[self.real_db(db)]
-
-    def get_queue_using(self, db=None):
-        return self._queues_using[self.real_db(db)]
+    def get_state(self, db=None):
+        return self._states[self.real_db(db)]
+
+    def route_read(self, db=None):
+        """The replica of db to read from, or db itself if it has no replica or it was written recently"""
+        db = self.real_db(db)
+        replicas = self._replicas.get(db)
+        if not replicas:
+            return db
+        balance, read_your_writes = self._read_policies[db]
+        if read_your_writes and time.time() - _last_writes.get().get(db, 0) < read_your_writes:
+            return db
+        if balance == 'least-using':
+            return min(replicas, key=lambda name: len(self._states[name].using) + len(self._states[name].waiters))
+        return replicas[next(self._round_robin[db]) % len(replicas)]
+
+    def mark_write(self, db=None):
+        """Stick the reads of the current context to the primary for ``ReadYourWrites`` seconds"""
+        db = self.real_db(db)
+        if db in self._read_policies and self._read_policies[db][1]:
+            last_writes = dict(_last_writes.get())
+            last_writes[db] = time.time()
+            _last_writes.set(last_writes)
 
     def __init__(self):
         self.ensure_inited()
         self.logger = self._logger or LOG
         self.logger.info('init')
 
-        self._queues = {}
-        self._queues_using = {}
+        self._states = {}
         self._loggers = {}
+        self._async_workers = {}
+        self._executors = {}
+        self._executors_lock = threading.Lock()
+        self._round_robin = {db: itertools.count() for db in self._replicas}
 
         for db in self._config:
             db_config = self.get_config(db)
@@ -147,34 +348,96 @@ class ConnectionPool(object):
             _max_connections = db_config.pop('MaxConnections', DEFAULT_CONNECTIONS)
             assert isinstance(_max_connections, int) and _max_connections > 0
 
-            self._queues[db] = Queue(_max_connections)  # create the queue
-            self._queues_using[db] = []
+            _acquire_timeout = db_config.pop('AcquireTimeout', DEFAULT_ACQUIRE_TIMEOUT)
+            assert _acquire_timeout is None or _acquire_timeout >= 0
+
+            _ping_interval = db_config.pop('PingInterval', DEFAULT_PING_INTERVAL)
+            assert _ping_interval >= 0
+
+            _validate_interval = db_config.pop('ValidateInterval', DEFAULT_VALIDATE_INTERVAL)
+            assert _validate_interval is None or _validate_interval > 0
+
+            _max_idle = db_config.pop('MaxIdle', _max_connections)
+            assert isinstance(_max_idle, int) and 0 <= _max_idle <= _max_connections
+
+            _min_idle = db_config.pop('MinIdle', min(DEFAULT_MIN_IDLE, _max_idle))
+            assert isinstance(_min_idle, int) and 0 <= _min_idle <= _max_idle
+
+            _max_lifetime = db_config.pop('MaxLifetime', DEFAULT_MAX_LIFETIME)
+            assert _max_lifetime is None or _max_lifetime > 0
+
+            _idle_timeout = db_config.pop('IdleTimeout', DEFAULT_IDLE_TIMEOUT)
+            assert _idle_timeout is None or _idle_timeout > 0
+
+            _slow_query_ms = db_config.pop('SlowQueryMs', DEFAULT_SLOW_QUERY_MS)
+            assert _slow_query_ms >= 0
+
+            _coalesce_reads = bool(db_config.pop('CoalesceReads', False))
+
+            _async_workers = db_config.pop('AsyncWorkers', _max_connections)
+            assert isinstance(_async_workers, int) and _async_workers > 0
+            self._async_workers[db] = _async_workers
+
+            self._states[db] = _PoolState(_max_connections, acquire_timeout=_acquire_timeout,
+                                          ping_interval=_ping_interval, validate_interval=_validate_interval,
+                                          min_idle=_min_idle, max_idle=_max_idle,
+                                          max_lifetime=_max_lifetime, idle_timeout=_idle_timeout,
+                                          slow_query_ms=_slow_query_ms, coalesce_reads=_coalesce_reads)
 
-            self.build_connection(db)  # build a connection
+        self.warm_up()
+
+        self._maintainer = None
+        if any(state.need_maintenance for state in self._states.values()):
+            self._maintainer = threading.Thread(target=self._maintain, name='ConnectionPool-maintainer')
+            self._maintainer.daemon = True
+            self._maintainer.start()
 
     def get_queue_status(self, db):
-        q = self.get_queue(db)
-        q_using = self.get_queue_using(db)
-        return 'queue of %s size: %s + %s / %s' % (db, q.qsize(), len(q_using), q.maxsize)
+        state = self.get_state(db)
+        return 'queue of %s size: %s + %s / %s, waiting: %s' % (
+            db, len(state.idle), len(state.using), state.max_connections, len(state.waiters))
+
+    def get_stats(self, db=None):
+        state = self.get_state(db)
+        with state.lock:
+            stats = dict(state.stats)
+            stats.update({
+                'idle': len(state.idle),
+                'using': len(state.using),
+                'size': state.size,
+                'max_connections': state.max_connections,
+                'waiting': len(state.waiters),
+            })
+        stats['wait_time_avg'] = stats['wait_time_total'] / stats['waited'] if stats['waited'] else 0.0
+        return stats
 
     def is_connection_using(self, conn, db=None):
         if db is None:
             return any((self.is_connection_using(conn, db) for db in self._config))
-        id_conn = id(conn)
-        q_using = self.get_queue_using(db)
-        self.logger.debug('is_connection_using(%s): %r in %r', db, id_conn, q_using)
-        return id_conn in q_using
-
-    def build_connection(self, db):
-        q = self.get_queue(db)
-        q_using = self.get_queue_using(db)
-        if q.qsize() + len(q_using) >= q.maxsize:
-            return
-
-        self.logger.debug('build connection at %s', db)
-        conn = self.connect(db)
-        q.put(conn)
-        self.logger.debug('after build connection, %s', self.get_queue_status(db))
+        return self.get_state(db).using.get(id(conn)) is conn
+
+    def build_connection(self, db, deadline=None):
+        state = self.get_state(db)
+        with state.lock:
+            if state.size >= state.max_connections:
+                return
+            state.size += 1
+
+        conn = self._connect_reserved(state, db, deadline)
+        with state.lock:
+            state.put_back(conn)
+
+    def warm_up(self):
+        """Build ``MinIdle`` connections of every database in parallel"""
+        threads = []
+        for db, state in self._states.items():
+            for _ in range(state.min_idle - state.size):
+                thread = threading.Thread(target=self.build_connection, args=(db,), name='ConnectionPool-warm-up')
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
 
     @classmethod
     def instance(cls):
@@ -185,7 +448,8 @@ class ConnectionPool(object):
                     cls._instance = cls()
         return cls._instance
 
-    def connect(self, db=DEFAULT_DB):
+    def connect(self, db=DEFAULT_DB, deadline=None):
+        """Connect the database, retry every second until succeeded or ``deadline`` (a timestamp) is passed"""
         self.ensure_inited()
 
         _config = copy.deepcopy(self.get_config(db))
@@ -199,241 +463,1422 @@ class ConnectionPool(object):
                 conn.ping()
                 break
             except Exception as e:
+                if deadline is not None and time.time() + 1 > deadline:
+                    self.logger.error('connect failed: %s', e)
+                    raise
                 self.logger.exception('connect failed: %s, retrying...', e)
                 time.sleep(1)
         self.logger.info('database connected')
         return conn
 
-    def acquire(self, db=DEFAULT_DB):
-        self.ensure_inited()
+    def _connect_reserved(self, state, db, deadline=None):
+        """Build a connection for a slot which is reserved already, give the slot back on failure."""
+        try:
+            conn = self.connect(db, deadline)
+        except BaseException:
+            with state.lock:
+                state.free_slot()
+            raise
+        with state.lock:
+            state.infos[id(conn)] = _ConnectionInfo()
+        return conn
 
-        q = self.get_queue(db)
-        q_using = self.get_queue_using(db)
-        self.logger.debug('acquire connection at %s', db)
-        if q.empty():
-            self.build_connection(db)
+    def _discard(self, state, conn, db, broken=True):
+        if broken:
+            self.logger.warning('Connection error, try to close it...')
+        try:
+            conn.close()
+        except Exception as conn_close_error:
+            self.get_logger(db).exception(conn_close_error)
+        with state.lock:
+            state.infos.pop(id(conn), None)
+            state.stats['discarded' if broken else 'retired'] += 1
+            state.free_slot()
+
+    def _ping(self, state, conn, db):
+        with state.lock:
+            state.stats['pings'] += 1
+        try:
+            with trace.span('ping', db):
+                conn.ping()
+        except Exception as e:
+            self.get_logger(db).exception(e)
+            return False
+        return True
+
+    def discard(self, conn, db=DEFAULT_DB):
+        """Close a connection in use (e.g. broken) instead of releasing it, its slot is given to others."""
+        state = self.get_state(db)
+        with state.lock:
+            if state.using.pop(id(conn), None) is None:
+                return
+        self._discard(state, conn, db)
+
+    def is_validated(self, conn, db=DEFAULT_DB):
+        """Whether the connection in use was pinged (or built) when it was acquired."""
+        info = self.get_state(db).infos.get(id(conn))
+        return info is not None and info.validated
+
+    def validate_idle(self, db):
+        """Ping the connections which are idle longer than ``PingInterval``, close the broken ones."""
+        state = self.get_state(db)
+        expired_at = time.time() - state.ping_interval
+        with state.lock:
+            conns = [conn for conn in state.idle if state.infos[id(conn)].released_at <= expired_at]
+            for conn in conns:
+                state.idle.remove(conn)
+
+        for conn in conns:
+            if self._ping(state, conn, db):
+                with state.lock:
+                    state.put_back(conn)
+            else:
+                self._discard(state, conn, db)
+
+    def reap_idle(self, db):
+        """Close the idle connections which are too old (``MaxLifetime``), idle for too long (``IdleTimeout``)
+        or too many (``MaxIdle``), then build new ones up to ``MinIdle``"""
+        state = self.get_state(db)
+        now = time.time()
+        with state.lock:
+            retired = [conn for conn in state.idle if state.is_expired(conn, now)]
+            for conn in retired:
+                state.idle.remove(conn)
+            # the longest idle ones are on the left
+            while state.idle and (len(state.idle) > state.max_idle or (
+                    state.idle_timeout and len(state.idle) > state.min_idle and
+                    now - state.infos[id(state.idle[0])].released_at > state.idle_timeout)):
+                retired.append(state.idle.popleft())
+
+        for conn in retired:
+            self._discard(state, conn, db, broken=False)
 
         while True:
-            conn = q.get()
-            conn_error = False
-            try:
-                LOG.debug('ping...')
-                conn.ping()
-                break
-            except Exception as e:
-                self.logger.exception(e)
-                conn_error = True
+            with state.lock:
+                if len(state.idle) >= state.min_idle or state.size >= state.max_connections:
+                    break
+            self.build_connection(db, deadline=time.time() + MAINTAIN_INTERVAL)
 
-            if conn_error:
-                self.logger.warning('Connection error, try to close it...')
+    def _maintain(self):
+        last_validated_at = dict.fromkeys(self._states, time.time())
+        while True:
+            time.sleep(MAINTAIN_INTERVAL)
+            for db, state in self._states.items():
+                if not state.need_maintenance:
+                    continue
                 try:
-                    conn.close()
-                except Exception as conn_close_error:
-                    self.logger.exception(conn_close_error)
-                self.build_connection(db)
+                    if state.validate_interval and time.time() - last_validated_at[db] >= state.validate_interval:
+                        self.validate_idle(db)
+                        last_validated_at[db] = time.time()
+                    self.reap_idle(db)
+                except Exception as e:
+                    self.get_logger(db).exception('maintain connections of %s failed: %s', db, e)
+
+    def _checkout(self, state, db, deadline):
+        """Take an idle connection, or reserve a slot (returns None), or wait in line for one of them."""
+        with state.lock:
+            state.stats['acquired'] += 1
+            if not state.waiters:
+                if state.idle:
+                    return state.idle.pop()
+                if state.size < state.max_connections:
+                    state.size += 1
+                    return None
+
+            waiter = _Waiter(state.lock)
+            state.waiters.append(waiter)
+            wait_started_at = time.time()
+            while waiter.connection is None and not waiter.granted:
+                if deadline is None:
+                    waiter.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                waiter.condition.wait(remaining)
+
+            wait_time = time.time() - wait_started_at
+            state.stats['waited'] += 1
+            state.stats['wait_time_total'] += wait_time
+            if wait_time > state.stats['wait_time_max']:
+                state.stats['wait_time_max'] = wait_time
+
+            if waiter.connection is None and not waiter.granted:
+                state.waiters.remove(waiter)
+                state.stats['timeouts'] += 1
+                raise PoolExhausted('no connection available at %s after %.3fs (%s)' % (
+                    db, wait_time, self.get_queue_status(db)))
+            return waiter.connection
+
+    def acquire(self, db=DEFAULT_DB, timeout=None, validate=False):
+        """Get a connection from the pool
+
+        :param db:
+        :param timeout: seconds to wait for a free connection, default to ``AcquireTimeout`` of db config,
+                        ``None`` means waiting forever
+        :param validate: always ping the connection, else only if it was idle longer than ``PingInterval``
+        :raise PoolExhausted: no connection available before timeout
+        """
+        self.ensure_inited()
 
-        q_using.append(id(conn))
-        self.logger.debug('after acquire connection, %s', self.get_queue_status(db))
+        db = self.real_db(db)
+        state = self.get_state(db)
+        if timeout is None:
+            timeout = state.acquire_timeout
+        deadline = None if timeout is None else time.time() + timeout
+
+        with trace.span('acquire', db):
+            while True:
+                conn = self._checkout(state, db, deadline)
+                if conn is None:
+                    conn = self._connect_reserved(state, db, deadline)
+                    break
+                if state.is_expired(conn, time.time()):
+                    self._discard(state, conn, db, broken=False)
+                    continue
+                info = state.infos[id(conn)]
+                info.validated = validate or time.time() - info.released_at > state.ping_interval
+                if not info.validated or self._ping(state, conn, db):
+                    break
+                self._discard(state, conn, db)
+
+        with state.lock:
+            state.using[id(conn)] = conn
         return conn
 
-    def release(self, conn, db=DEFAULT_DB):
-        # import traceback
-        # self.logger.debug('TraceBack:\n' + (''.join(traceback.format_stack())))
-
-        self.ensure_inited()
+    def get_executor(self, db=None):
+        """The thread pool running the blocking calls of db for asyncio, at most ``AsyncWorkers`` at a time"""
+        db = self.real_db(db)
+        executor = self._executors.get(db)
+        if executor is None:
+            with self._executors_lock:
+                executor = self._executors.get(db)
+                if executor is None:
+                    executor = ThreadPoolExecutor(self._async_workers[db], thread_name_prefix='ConnectionPool-%s' % db)
+                    self._executors[db] = executor
+        return executor
+
+    def submit(self, db, fn):
+        """Call ``fn()`` in the executor of db with the current context, returns an awaitable asyncio future"""
+        context = contextvars.copy_context()
+        return asyncio.wrap_future(self.get_executor(db).submit(context.run, fn))
+
+    def coalesce(self, db, key, fn, share=None):
+        """Call ``fn()`` once for the concurrent callers of the same key (singleflight): the first one runs it,
+        the others wait for it and get ``share(result)``, or its exception
+
+        :param share: copy the result for the waiting callers, if it is mutable, the result of the leader is never
+                      handed out
+        """
+        state = self.get_state(db)
+        with state.lock:
+            flight = state.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = state.flights[key] = _Flight()
+            else:
+                state.stats['coalesced'] += 1
 
-        id_conn = id(conn)
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result if share is None else share(flight.result)
 
-        q = self.get_queue(db)
-        q_using = self.get_queue_using(db)
+        try:
+            result = fn()
+            # copied before the leader returns, so the waiting callers never see what it does with its result
+            flight.result = result if share is None else share(result)
+            return result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with state.lock:
+                del state.flights[key]
+            flight.event.set()
 
-        if not self.is_connection_using(conn, db):
-            self.logger.warning('The connection #%d is not using, ignore release... (using connections: %r)', id_conn,
-                                q_using)
-            return
+    def release(self, conn, db=DEFAULT_DB):
+        self.ensure_inited()
 
-        self.logger.debug('release connection %d at %s', id_conn, db)
-        q.put(conn)
-        q_using.remove(id_conn)
-        self.logger.debug('after release connection, %s', self.get_queue_status(db))
+        state = self.get_state(db)
+        with state.lock:
+            if state.using.pop(id(conn), None) is None:
+                self.logger.warning('The connection #%d is not using, ignore release...', id(conn))
+                return
+            if state.waiters or not (state.is_expired(conn, time.time()) or len(state.idle) >= state.max_idle):
+                state.put_back(conn)
+                return
+        self._discard(state, conn, db, broken=False)
 
 
 class ConnectionContext:
-    def __init__(self, db):
+    def __init__(self, db, timeout=None, validate=False):
         self.db = db
+        self.timeout = timeout
+        self.validate = validate
         self.connection = None  # pymysql.Connection
+        self.pooled = None  # PooledConnection
 
     def __enter__(self):
         pool = ConnectionPool.instance()
-        self.connection = pool.acquire(self.db)
-        return PooledConnection(pool, self.db, self.connection)
+        self.connection = pool.acquire(self.db, timeout=self.timeout, validate=self.validate)
+        self.pooled = PooledConnection(pool, self.db, self.connection)
+        return self.pooled
+
+    @property
+    def validated(self):
+        return ConnectionPool.instance().is_validated(self.connection, self.db)
+
+    def discard(self):
+        ConnectionPool.instance().discard(self.connection, self.db)
 
     def __exit__(self, *args):
         """args: type, value, trace"""
         pool = ConnectionPool.instance()
         if pool.is_connection_using(self.connection, self.db):
             pool.release(self.connection, self.db)
+        # the wrapper may outlive the context (see ``result['conn']``), do not let it release again
+        self.pooled.detach()
+
+
+_transactions = contextvars.ContextVar('lian.orm.db.transactions', default={})  # real db => Transaction
+
+
+class Transaction(object):
+    """Unit of work: all the SQL of db executed in the context (the BASE operations included) run on one
+    connection, and are committed once at the end, or rolled back on exception
+
+    Errors are raised inside a transaction instead of returning None. Nested transactions of the same db
+    join the outermost one.
+    """
+
+    def __init__(self, db=DEFAULT_DB, timeout=None):
+        self.db = ConnectionPool.real_db(db)
+        self.timeout = timeout
+        self.lock = threading.RLock()  # the connection may be shared with executor threads (aquery, ...)
+        self.context = None  # ConnectionContext
+        self.connection = None  # PooledConnection
+        self.callbacks = []  # called after committed
+        self.written = False  # execute (not query) was called
+        self._outer = None
+        self._token = None
+
+    @staticmethod
+    def current(db=DEFAULT_DB):
+        return _transactions.get().get(ConnectionPool.real_db(db))
+
+    def __enter__(self):
+        self._outer = self.current(self.db)
+        if self._outer is not None:
+            return self._outer
+
+        self.context = ConnectionContext(self.db, timeout=self.timeout, validate=True)
+        self.connection = self.context.__enter__()
+        try:
+            self.connection.begin()
+        except BaseException:
+            self.context.discard()
+            self.context.__exit__()
+            raise
+        transactions = dict(_transactions.get())
+        transactions[self.db] = self
+        self._token = _transactions.set(transactions)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._outer is not None:
+            return False
+
+        _transactions.reset(self._token)
+        try:
+            with self.lock:
+                if exc_type is None:
+                    if self.written:
+                        ConnectionPool.instance().mark_write(self.db)
+                    with trace.span('commit', self.db):
+                        self.connection.commit()
+                else:
+                    self.connection.rollback()
+        except Exception:
+            self.context.discard()
+            raise
+        finally:
+            self.context.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            for callback in self.callbacks:
+                callback()
+        return False
+
+    def after_commit(self, callback):
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+
+    def run(self, sql, need_return=False, row_format='dict', row_name='Row', many=False):
+        if not need_return:
+            self.written = True
+        with self.lock:
+            try:
+                return _run(self.connection, sql, need_return, row_format, row_name, self.db, many)
+            except Exception as e:
+                self.connection.logger.exception('db %s (transaction): %s', self.db, e)
+                raise
+
+    def execute(self, sql):
+        return self.run(sql, need_return=False)
+
+    def query(self, sql, row_format='dict'):
+        return self.run(sql, need_return=True, row_format=row_format)
+
+
+def transaction(db=DEFAULT_DB, timeout=None):
+    """``with db.transaction('default') as tx: ...``"""
+    return Transaction(db, timeout=timeout)
+
+
+class Batch(object):
+    """Statements (e.g. the many tiny writes of a job) executed together in one transaction, committed once
+
+        with db.batch('default') as batch:
+            for item in items:
+                batch.add(sql.update({'count': item['count']}, {'id': item['id']}))
+        batch.rowcounts  # [1, 1, 0, ...]
+
+    If the connections of db have the ``CLIENT.MULTI_STATEMENTS`` flag (``client_flag`` of db config), the
+    statements are sent together, up to ``max_bytes`` per round trip, instead of one by one.
+    """
+
+    def __init__(self, db=DEFAULT_DB, timeout=None, max_bytes=statement.INSERT_MANY_MAX_BYTES):
+        self.db = db
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.statements = []
+        self.rowcounts = None
+
+    def __len__(self):
+        return len(self.statements)
+
+    def add(self, sql):
+        """:param sql: SQL, or (template, params) of a parameterized ``statement.SQL``"""
+        self.statements.append(sql)
+        return self
+
+    def _chunks(self, statements):
+        chunk, size = [], 0
+        for sql in statements:
+            sql_size = len(sql.encode('utf-8')) + 2  # with the separator
+            if chunk and size + sql_size > self.max_bytes:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(sql)
+            size += sql_size
+        if chunk:
+            yield chunk
+
+    def _run_multi(self, tx, statements):
+        rowcounts = []
+        cur = tx.connection.cursor(pymysql.cursors.Cursor)
+        try:
+            statements = [sql if isinstance(sql, str) else literal(*sql) for sql in statements]
+            for chunk in self._chunks(statements):
+                sql = ';\n'.join(chunk)
+                with trace.span('execute', tx.db, sql):
+                    cur.execute(sql)
+                    rowcounts.append(cur.rowcount)
+                    while cur.nextset():
+                        rowcounts.append(cur.rowcount)
+        finally:
+            cur.close()
+        return rowcounts
+
+    def execute(self):
+        """Execute the statements added (errors are raised and nothing is committed)
+
+        :return: rowcounts of the statements
+        """
+        statements, self.statements = self.statements, []
+        self.rowcounts = []
+        if not statements:
+            return self.rowcounts
+        with Transaction(self.db, timeout=self.timeout) as tx:
+            with tx.lock:
+                tx.written = True
+                if tx.connection.client_flag & CLIENT.MULTI_STATEMENTS:
+                    self.rowcounts = self._run_multi(tx, statements)
+                else:
+                    self.rowcounts = [tx.run(sql)['rowcount'] for sql in statements]
+        return self.rowcounts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
+
+
+def batch(db=DEFAULT_DB, timeout=None, max_bytes=statement.INSERT_MANY_MAX_BYTES):
+    """``with db.batch('default') as batch: batch.add(sql)...``, see ``Batch``"""
+    return Batch(db, timeout=timeout, max_bytes=max_bytes)
+
+
+def _split_sql(sql):
+    """SQL, or (template, params) as built by a parameterized ``statement.SQL`` => (sql, params or None)"""
+    if isinstance(sql, tuple):
+        return sql
+    return sql, None
+
 
+def _run(conn, sql, need_return=False, row_format='dict', row_name='Row', db=DEFAULT_DB, many=False):
+    """Execute SQL on the connection, the slow ones are logged, and recorded into ``lian.orm.stats`` if enabled
 
-def _execute(sql, need_return=False, auto_commit=False, db=DEFAULT_DB):
+    :param many: ``sql`` is (template, params list), run by ``cursor.executemany``
+    """
+    sql, params = _split_sql(sql)
+    cur = conn.cursor(pymysql.cursors.Cursor if row_formats.is_tuple_format(row_format) else None)
+    started_at = time.time()
+    rowcount = 0
+    error = True
+    try:
+        with trace.span('execute', db, sql):
+            rowcount = cur.executemany(sql, params) if many else cur.execute(sql, params)
+        if need_return:
+            with trace.span('fetch', db):
+                rows = cur.fetchall()
+            result = {'rows': row_formats.format_rows(rows, cur.description, row_format, row_name)}
+        else:
+            result = {'rows': None}
+
+        result.update({
+            'conn': conn,
+            'rowcount': rowcount,
+            'description': cur.description,
+            'lastrowid': cur.lastrowid,
+        })
+        error = False
+        return result
+    finally:
+        cur.close()
+        time_cost = (time.time() - started_at) * 1000
+        slow = time_cost > ConnectionPool.instance().get_state(db).slow_query_ms
+        if slow:
+            conn.logger.warning('db %s: slow sql (%.3f ms): %s', db, time_cost, sql)
+        if statement_stats.STATS.enabled:
+            statement_stats.STATS.record(sql, time_cost, rows=rowcount or 0, error=error, slow=slow)
+
+
+def _execute(sql, need_return=False, auto_commit=False, db=DEFAULT_DB, validate=False, raise_error=False,
+             row_format='dict', row_name='Row', many=False):
     """Execute SQL
 
-    :param sql:
+    The connection is not pinged if it was used recently, so if it turns out to be broken before anything
+    is committed, it is discarded and the SQL is retried once on a validated connection: the reads on any
+    connection error, the writes only if the statement was not sent (CR_SERVER_GONE_ERROR), as the server
+    may have applied it otherwise (e.g. CR_SERVER_LOST with ``autocommit``).
+
+    In a transaction of db, the SQL runs on the connection of the transaction, is not committed immediately,
+    and errors are always raised.
+
+    :param sql: SQL, or (template, params) as built by a parameterized ``statement.SQL``
     :param need_return:
     :param auto_commit:
+    :param validate: ping the connection before executing
+    :param raise_error: raise the exception instead of returning None
+    :param row_format: dict, tuple, namedtuple or slots, see ``lian.orm.rows``
+    :param row_name: class name of the namedtuple / slots rows
+    :param many: ``sql`` is (template, params list), run by ``cursor.executemany``
     :return:
     """
-    with ConnectionContext(db) as conn:
-        query_uuid = uuid.uuid1()
-        conn.logger.debug('[%s] db %s: sql execute start...', query_uuid, db)
-        conn.logger.debug('[%s] sql: %s', query_uuid, sql)
-        cur = None
-        started_at = time.time()
+    current = Transaction.current(db)
+    if current is not None:
+        return current.run(sql, need_return, row_format, row_name, many)
+
+    context = ConnectionContext(db, validate=validate)
+    with context as conn:
+        if conn.logger.isEnabledFor(logging.DEBUG):
+            conn.logger.debug('db %s: %s', db, sql)
+        retryable = not context.validated
         try:
-            cur = conn.cursor()
-            rowcount = cur.execute(sql)
+            result = _run(conn, sql, need_return, row_format, row_name, db, many)
             if auto_commit:
-                conn.commit()
-
-            if need_return:
-                result = {'rows': cur.fetchall()}
-            else:
-                result = {'rows': None}
-
-            result.update({
-                'conn': conn,
-                'rowcount': rowcount,
-                'description': cur.description,
-                'lastrowid': cur.lastrowid,
-            })
-            # conn.logger.debug('[%s] %r', query_uuid, result)
+                retryable = False
+                with trace.span('commit', db):
+                    conn.commit()
             return result
         except Exception as e:
-            conn.logger.exception('[%s] db %s: %s', query_uuid, db, e)
+            if retryable and (is_connection_error(e) if need_return else is_unsent_error(e)):
+                conn.logger.warning('db %s: connection broken (%s), retrying...', db, e)
+                context.discard()
+                return _execute(sql, need_return=need_return, auto_commit=auto_commit, db=db, validate=True,
+                                raise_error=raise_error, row_format=row_format, row_name=row_name, many=many)
+            conn.logger.exception('db %s: %s', db, e)
+            if raise_error:
+                raise
+
+
+def read_db(db=DEFAULT_DB):
+    """Where to read db from: a replica, or the primary in a transaction or after a recent write"""
+    if Transaction.current(db) is not None:
+        return db
+    return ConnectionPool.instance().route_read(db)
+
+
+def execute(sql, auto_commit=False, db=DEFAULT_DB, raise_error=False):
+    ConnectionPool.instance().mark_write(db)
+    return _execute(sql, need_return=False, auto_commit=auto_commit, db=db, raise_error=raise_error)
+
+
+def execute_many(sql, params_list, auto_commit=False, db=DEFAULT_DB, raise_error=False):
+    """``cursor.executemany``: a template run with every params of the list, the INSERT / REPLACE are
+    rewritten by pymysql into bulk statements, e.g. ``execute_many(*SQL('t', parameterized=True).insert_many(...))``
+    """
+    ConnectionPool.instance().mark_write(db)
+    return _execute((sql, params_list), need_return=False, auto_commit=auto_commit, db=db, raise_error=raise_error,
+                    many=True)
+
+
+def _copy_result(result):
+    if result is None:
+        return None
+    return dict(result, rows=[copy.copy(row) for row in result['rows']])
+
+
+def query(sql, auto_commit=True, db=DEFAULT_DB, row_format='dict', row_name='Row', replica=True, coalesce=None,
+          raise_error=False):
+    """
+    :param replica: read from a replica of db if any, see ``read_db``
+    :param coalesce: share the execution with the concurrent calls of the same SQL (the rows are copied),
+                     default to ``CoalesceReads`` of db config, never in a transaction
+    :param raise_error: raise the exception instead of returning None
+    """
+    if replica:
+        db = read_db(db)
+    run = functools.partial(_execute, sql, need_return=True, auto_commit=auto_commit, db=db, row_format=row_format,
+                            row_name=row_name, raise_error=raise_error)
+    if Transaction.current(db) is None:
+        pool = ConnectionPool.instance()
+        if coalesce is None:
+            coalesce = pool.get_state(db).coalesce_reads
+        if coalesce:
+            key = sql if isinstance(sql, str) else (sql[0], repr(sql[1]))
+            return pool.coalesce(db, (key, auto_commit, row_format, row_name, raise_error), run,
+                                 share=_copy_result)
+    return run()
+
+
+def _iter_cursor(cur, batch_size=None, row_format='dict', row_name='Row'):
+    convert = row_formats.converter(cur.description, row_format, row_name)
+    if batch_size:
+        rows = cur.fetchmany(batch_size)
+        while rows:
+            yield [convert(row) for row in rows] if convert else list(rows)
+            rows = cur.fetchmany(batch_size)
+    else:
+        row = cur.fetchone()
+        while row is not None:
+            yield convert(row) if convert else row
+            row = cur.fetchone()
+
+
+@contextlib.contextmanager
+def _streaming_cursor(sql, db, cursor_class):
+    """An executed unbuffered cursor, on the connection of the transaction of db if any
+
+    The unread rows are not drained if the context exits early, the connection is closed instead.
+    """
+    sql, params = _split_sql(sql)
+    current = Transaction.current(db)
+    if current is not None:
+        with current.lock:
+            cur = current.connection.cursor(cursor_class)
+            try:
+                with trace.span('execute', db, sql):
+                    cur.execute(sql, params)
+                yield cur
+            finally:
+                cur.close()  # drain the unread rows, the connection is still in use
+        return
+
+    context = ConnectionContext(db, validate=True)
+    with context as conn:
+        conn.logger.debug('db %s: streaming sql: %s', db, sql)
+        cur = conn.cursor(cursor_class)
+        exhausted = False
+        try:
+            with trace.span('execute', db, sql):
+                cur.execute(sql, params)
+            yield cur
+            exhausted = True
         finally:
-            time_cost = time.time() - started_at
-            if time_cost > 100:
-                conn.logger.warning('[%s] slow sql, cost: %f', query_uuid, time_cost)
-            else:
-                conn.logger.debug('[%s] cost: %f', query_uuid, time_cost)
-            if cur:
-                conn.logger.debug('[%s] close cursor...', query_uuid)
+            if exhausted:
                 cur.close()
-            conn.logger.debug('[%s] db %s: sql execute over...', query_uuid, db)
+            else:
+                context.discard()
+
 
+def iter_query(sql, batch_size=None, db=DEFAULT_DB, row_format='dict', row_name='Row', replica=True):
+    """Stream the result of SQL with an unbuffered server side cursor
 
-def execute(sql, auto_commit=False, db=DEFAULT_DB):
-    return _execute(sql, need_return=False, auto_commit=auto_commit, db=db)
+    The connection stays checked out until the generator is exhausted or closed. The unread rows are not
+    drained when it is closed early, the connection is closed instead. In a transaction, do not run other
+    SQL of db before the generator ends.
+
+    :param sql:
+    :param batch_size: yield lists of at most ``batch_size`` rows instead of single rows
+    :param db:
+    :param row_format: dict, tuple, namedtuple or slots, see ``lian.orm.rows``
+    :param row_name: class name of the namedtuple / slots rows
+    :param replica: read from a replica of db if any, see ``read_db``
+    """
+    cursor_class = pymysql.cursors.SSCursor if row_formats.is_tuple_format(row_format) else pymysql.cursors.SSDictCursor
+    with _streaming_cursor(sql, read_db(db) if replica else db, cursor_class) as cur:
+        for row in _iter_cursor(cur, batch_size, row_format, row_name):
+            yield row
+
+
+def query_columns(sql, db=DEFAULT_DB, batch_size=row_formats.COLUMNS_BATCH_SIZE, use_numpy=None, replica=True):
+    """Columnar result of SQL: {column name: array}, built from an unbuffered cursor batch by batch
+
+    :param use_numpy: NumPy arrays, or ``array.array`` / list, default to NumPy if installed,
+                      see ``lian.orm.rows.ColumnsBuilder``
+    :param replica: read from a replica of db if any, see ``read_db``
+    """
+    with _streaming_cursor(sql, read_db(db) if replica else db, pymysql.cursors.SSCursor) as cur:
+        builder = row_formats.ColumnsBuilder(cur.description, use_numpy)
+        rows = cur.fetchmany(batch_size)
+        while rows:
+            builder.extend(rows)
+            rows = cur.fetchmany(batch_size)
+    return builder.build()
 
 
-def query(sql, auto_commit=True, db=DEFAULT_DB):
-    return _execute(sql, need_return=True, auto_commit=auto_commit, db=db)
+def aexecute(sql, auto_commit=False, db=DEFAULT_DB):
+    """Awaitable ``execute``, runs in the executor of db without blocking the IOLoop"""
+    pool = ConnectionPool.instance()
+    pool.mark_write(db)  # in the context of the caller, the executor runs a copy of it
+    return pool.submit(db, functools.partial(execute, sql, auto_commit=auto_commit, db=db))
+
+
+def aquery(sql, auto_commit=True, db=DEFAULT_DB):
+    """Awaitable ``query``, runs in the executor of db without blocking the IOLoop"""
+    return ConnectionPool.instance().submit(db, functools.partial(query, sql, auto_commit=auto_commit, db=db))
 
 
 class ObjectNotFound(Exception):
     pass
 
 
+_MISSING = object()
+
+
+def _tag_cursor_value(value):
+    # the key values are tagged to be decoded exactly, e.g. the microseconds of DATETIME(6), large DECIMAL
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, datetime.timedelta):  # TIME
+        return {'$timedelta': [value.days, value.seconds, value.microseconds]}
+    if isinstance(value, decimal.Decimal):
+        return {'$decimal': str(value)}
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    raise TypeError('unsupported type of cursor key: %s' % type(value).__name__)
+
+
+_CURSOR_TYPES = {
+    '$datetime': datetime.datetime.fromisoformat,
+    '$date': datetime.date.fromisoformat,
+    '$timedelta': lambda value: datetime.timedelta(*value),
+    '$decimal': decimal.Decimal,
+    '$bytes': base64.b64decode,
+}
+
+
+def _untag_cursor_value(obj):
+    if len(obj) == 1:
+        tag, value = next(iter(obj.items()))
+        if tag in _CURSOR_TYPES:
+            return _CURSOR_TYPES[tag](value)
+    return obj
+
+
+def encode_cursor(values):
+    """The key values (None, bool, int, float, str, datetime, date, TIME timedelta, Decimal, bytes) as an opaque
+    token, decoded to the same values and types"""
+    content = json.dumps(values, default=_tag_cursor_value, ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(content.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'),
+                      object_hook=_untag_cursor_value)
+
+
+class _ModelMeta(object):
+    """What a model class needs on a db config, resolved once (again if the pool is initialized again)"""
+
+    __slots__ = ('config', 'database_name', 'full_table_name', 'fields', 'logger', 'sql', 'cache_options',
+                 'cache_name', 'query_cache')
+
+    def __init__(self, cls, db):
+        self.config = ConnectionPool._config
+        config = ConnectionPool.get_config(db=db)
+        name = config.get('database', None) or config.get('db', None)
+        if name is None:
+            raise Exception('model %s has not specified database!' % cls.__name__)
+        self.database_name = name
+        self.full_table_name = '%s.%s' % (name, cls._table_name)
+        self.fields = tuple(cls.__fields__)
+        self.logger = ConnectionPool.instance().get_logger(db)
+        self.sql = statement.SQL(cls._table_name, database=name, logger=self.logger,
+                                 parameterized=cls.__parameterized__)
+        self.cache_options = cls.__cache__
+        # per db config: the shards usually have the same database name on different hosts
+        self.cache_name = '%s:%s' % (ConnectionPool.real_db(db), self.full_table_name)
+        self.query_cache = None
+
+    def get_query_cache(self):
+        if self.query_cache is None and self.cache_options:
+            options = {} if self.cache_options is True else self.cache_options
+            self.query_cache = query_cache.QueryCache(self.cache_name, **options)
+        return self.query_cache
+
+
+def _aggregated(fields):
+    for field in fields or ():
+        name = field[0] if isinstance(field, tuple) else field
+        if statement.RE_FUNC.search(name) or name.startswith('*'):
+            return True
+    return False
+
+
+def _project(rows, size, row_format, row_name):
+    """The merged rows in the row format, with the first ``size`` columns only (all of them if None)"""
+    if row_format == 'tuple':
+        return [tuple(row)[:size] for row in rows]
+    if size is None or not rows:
+        return rows
+    if row_format == 'dict':
+        return [dict(itertools.islice(row.items(), size)) for row in rows]
+    cls = row_formats.row_class(row_format, row_name, rows[0]._columns[:size])
+    return [cls(*tuple(row)[:size]) for row in rows]
+
+
 class BASE(object):
     __database__ = DEFAULT_DB
     __table__ = ''
     __pk__ = 'id'
     __fields__ = tuple()
+    __cache__ = None  # {'ttl': 30, 'max_entries': 10000, 'backend': 'memory'}, see lian.orm.cache
+    __row_format__ = 'dict'  # default row format of select, see lian.orm.rows
+    __shard_key__ = None
+    __shards__ = ()  # names of db config, see lian.orm.shard
+    __shard_router__ = ModuloRouter()
+    __parameterized__ = False  # run (template, params) with pymysql instead of SQL with values escaped in
+    __in_chunk_size__ = 1000  # longer IN lists of select / count are split into queries run in parallel
+    __in_parallel__ = 4  # queries of the IN chunks run at the same time
+    __in_temp_table_size__ = None  # integer IN lists at least that long are joined from a temporary table
+
+    _cached_models = []  # the subclasses with __cache__, invalidated by the writes of any model of their tables
+
+    def __init_subclass__(cls, **kwargs):
+        super(BASE, cls).__init_subclass__(**kwargs)
+        cls._table_name = cls.__table__ or camel2underline(cls.__name__)
+        cls._metas = {}  # db => _ModelMeta
+        if cls.__cache__:
+            BASE._cached_models.append(cls)
 
     def __init__(self):
-        self.sql = statement.SQL(self.table_name, database=self.database_name, logger=self.logger)
+        if self.__shards__ and self.__database__ not in self.__shards__:
+            self.__database__ = self.__shards__[0]
+        self._meta = self._get_meta(self.__database__)
+        self._bound_models = {}
+
+    @classmethod
+    def _get_meta(cls, db):
+        if cls is BASE:
+            raise NotImplementedError
+        meta = cls._metas.get(db)
+        if meta is None or meta.config is not ConnectionPool._config:
+            meta = cls._metas[db] = _ModelMeta(cls, db)
+        return meta
+
+    @property
+    def sql(self):
+        return self._meta.sql
 
     @property
     def table_name(self):
         if self.__class__ is BASE:
             raise NotImplementedError
-        if self.__table__:
-            return self.__table__
-        return camel2underline(self.__class__.__name__)
+        return self._table_name
 
     @property
     def database_name(self):
         # 获取真实的数据库名称
-        config = ConnectionPool.get_config(db=self.__database__)
-        name = config.get('database', None) or config.get('db', None)
-        if name is None:
-            raise Exception('model %s has not specified database!' % self.__class__.__name__)
-        return name
+        return self._meta.database_name
 
     @property
     def full_table_name(self):
-        return '%s.%s' % (self.database_name, self.table_name)
+        return self._meta.full_table_name
 
     @property
     def logger(self):
+        return self._meta.logger
+
+    @property
+    def query_cache(self):
+        """The query cache of the model on its db config, None if the model has no ``__cache__``"""
+        return self._meta.get_query_cache()
+
+    @property
+    def row_name(self):
+        return self.__class__.__name__ + 'Row'
+
+    def _query(self, sql, row_format='dict', replica=True, cached=True, raise_error=False):
+        """Rows of the SQL (None if failed, unless ``raise_error``), through the query cache of the model,
+        except in a transaction, reading the primary (``replica=False``, e.g. right after a write), or if not
+        ``cached`` (the SQL reads other tables, whose writes do not invalidate the cache)"""
+        cache = self.query_cache
+        if cache is not None and cached and replica and Transaction.current(self.__database__) is None:
+            cache_sql = sql if isinstance(sql, str) else '%s -- %r' % sql
+            if row_format != 'dict':
+                cache_sql = '/* %s */ %s' % (row_format, cache_sql)
+            key, rows = cache.lookup(cache_sql)
+            if rows is not None:
+                return rows
+            result = query(sql, db=self.__database__, row_format=row_format, row_name=self.row_name,
+                           raise_error=raise_error)
+            if result:
+                cache.store(key, result['rows'])
+        else:
+            result = query(sql, db=self.__database__, row_format=row_format, row_name=self.row_name,
+                           replica=replica, raise_error=raise_error)
+        return result['rows'] if result else None
+
+    def using(self, db):
+        """A copy of the model working on another db config (e.g. a shard), not sharded any more"""
+        model = self._bound_models.get(db)
+        if model is None:
+            model = copy.copy(self)
+            model.__database__ = db
+            model.__shards__ = ()
+            model._meta = self._get_meta(db)
+            model._bound_models = {}
+            self._bound_models[db] = model
+        return model
+
+    def shard(self, key):
+        """The model bound to the shard of the shard key value"""
+        return self.using(type(self).__shard_router__(key, self.__shards__))
+
+    def route(self, conditions=None):
+        """The models bound to the shards concerned by the conditions, None if the model is not sharded
+
+        Only the shard key (or ``<shard key>__in``) at the top level of dict conditions is routed, all the
+        shards are concerned otherwise.
+        """
+        if not self.__shards__:
+            return None
+        value = _MISSING
+        if isinstance(conditions, dict):
+            value = conditions.get(self.__shard_key__, conditions.get(self.__shard_key__ + '__in', _MISSING))
+        if value is _MISSING or value is None:
+            dbs = self.__shards__
+        elif isinstance(value, (list, tuple, set)):
+            router = type(self).__shard_router__
+            dbs = []
+            for i in value:
+                db = router(i, self.__shards__)
+                if db not in dbs:
+                    dbs.append(db)
+        else:
+            dbs = [type(self).__shard_router__(value, self.__shards__)]
+        return [self.using(db) for db in dbs]
+
+    def _single_shard(self, conditions):
+        models = self.route(conditions)
+        if models is None:
+            return self
+        if len(models) != 1:
+            raise Exception('conditions of %s should be routed to a single shard' % self.__class__.__name__)
+        return models[0]
+
+    @staticmethod
+    def _parallel(calls, workers=None):
+        """Call the functions (no argument) in parallel with the current context, returns the results in order"""
+        if len(calls) <= 1 or workers == 1:
+            return [call() for call in calls]
+        with ThreadPoolExecutor(min(workers or len(calls), len(calls))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, call) for call in calls]
+            return [future.result() for future in futures]
+
+    @staticmethod
+    def _mark_write(models):
+        """Stick the reads of the current context to the primaries of the models written in other threads or
+        contexts (``_parallel``, executors...), where ``execute`` marked only the copies of the context"""
         pool = ConnectionPool.instance()
-        return pool.get_logger(self.database_name)
+        for model in models:
+            for db in model.__shards__ or (model.__database__,):
+                pool.mark_write(db)
+
+    @staticmethod
+    def _scatter(models, method, *args, **kwargs):
+        """Call the method of the models in parallel, returns the results in order"""
+        return BASE._parallel([functools.partial(getattr(model, method), *args, **kwargs) for model in models])
+
+    def _large_in(self, conditions):
+        """(key, values without duplicates) of the longest IN list of the dict conditions if it is longer than
+        ``__in_chunk_size__``, else None"""
+        if not isinstance(conditions, dict):
+            return None
+        found = None
+        for key, value in conditions.items():
+            if not isinstance(value, (list, tuple, set)) or (
+                    '__' in key and not key.endswith('__in')) or len(value) <= self.__in_chunk_size__:
+                continue
+            if found is None or len(value) > len(found[1]):
+                found = key, value
+        if found is None:
+            return None
+        return found[0], list(dict.fromkeys(found[1]))
+
+    def _in_chunks(self, conditions, key, values):
+        size = self.__in_chunk_size__
+        return [dict(conditions, **{key: values[i:i + size]}) for i in range(0, len(values), size)]
+
+    def _in_workers(self):
+        return 1 if Transaction.current(self.__database__) is not None else self.__in_parallel__
+
+    def _select_large_in(self, key, values, fields, conditions, limit, offset, order_by, group_by, row_format,
+                         raise_error=False, alias=None):
+        """Select with a long IN list: from a temporary table of the keys, or in chunks merged afterwards"""
+        temp_table_size = self.__in_temp_table_size__
+        if temp_table_size is not None and len(values) >= temp_table_size and \
+                all(isinstance(value, int) for value in values):
+            return self._select_temp_table(key, values, fields, conditions, limit, offset, order_by, group_by,
+                                           row_format, raise_error, alias)
+        if group_by or _aggregated(fields):  # the rows of the chunks could not be merged
+            return None
 
-    def get(self, pk, key=None):
+        chunk_limit = None if limit is None else limit + (offset or 0)
+
+        def _select_chunks(chunk_fields, chunk_format):
+            calls = [functools.partial(self.select, chunk_fields, chunk, chunk_limit, None, order_by,
+                                       row_format=chunk_format, alias=alias, raise_error=raise_error)
+                     for chunk in self._in_chunks(conditions, key, values)]
+            return self._parallel(calls, self._in_workers())
+
+        return self._merge_select(_select_chunks, fields, order_by, offset, limit, row_format)
+
+    def _merge_select(self, select_parts, fields, order_by, offset, limit, row_format):
+        """Rows of a select run in parts (shards, IN chunks), merged in the order of ``order_by``
+
+        The columns of ``order_by`` missing in ``fields`` are selected for the merging, then dropped, and the
+        tuple rows are selected as namedtuple to be merged by name.
+
+        :param select_parts: callable(fields, row format) => rows of every part
+        """
+        row_format = row_format or self.__row_format__
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        size = None
+        if fields and order_by:
+            aliases = [field[1] for field in fields if isinstance(field, tuple)]  # keys of the rows already
+            added = [name for name in [i.lstrip('-') for i in order_by] if name not in fields and name not in aliases]
+            if added:
+                size = len(fields)
+                fields = list(fields) + added
+        parts_format = 'namedtuple' if row_format == 'tuple' and order_by else row_format
+        rows = merge_rows(select_parts(fields, parts_format), order_by, offset, limit)
+        if parts_format == row_format and size is None:
+            return rows
+        return _project(rows, size, row_format, self.row_name)
+
+    def _select_temp_table(self, key, values, fields, conditions, limit, offset, order_by, group_by, row_format,
+                           raise_error=False, alias=None):
+        table = statement.SQL(IN_TEMP_TABLE)
+        field = key[:-len('__in')] if key.endswith('__in') else key
+        rest = dict(conditions)
+        rest.pop(key)
+        join = '%s IN (SELECT `k` FROM `%s`)' % (quote_field(escaped_str(field)), IN_TEMP_TABLE)
+        with transaction(self.__database__) as tx:
+            tx.execute('DROP TEMPORARY TABLE IF EXISTS `%s`' % IN_TEMP_TABLE)
+            tx.execute('CREATE TEMPORARY TABLE `%s` (`k` BIGINT PRIMARY KEY)' % IN_TEMP_TABLE)
+            try:
+                for sql, _ in table.insert_many_chunks(['k'], [(value,) for value in values]):
+                    tx.execute(sql)
+                return self.select(fields, (rest, join) if rest else join, limit, offset, order_by, group_by,
+                                   row_format=row_format, alias=alias, raise_error=raise_error)
+            finally:
+                tx.execute('DROP TEMPORARY TABLE IF EXISTS `%s`' % IN_TEMP_TABLE)
+
+    def _table_caches(self):
+        """The query caches of the models (cached or not) reading the table of the model on its db config"""
+        table, real_db = self.full_table_name, ConnectionPool.real_db(self.__database__)
+        caches = []
+        for cls in BASE._cached_models:
+            if cls._table_name != self._table_name:
+                continue
+            for db in cls.__shards__ or (cls.__database__,):
+                if ConnectionPool.real_db(db) != real_db:
+                    continue
+                meta = cls._get_meta(db)
+                if meta.full_table_name == table and meta.get_query_cache() not in caches:
+                    caches.append(meta.get_query_cache())
+        return caches
+
+    def _invalidate(self):
+        context = loader.current()
+        if context is not None:
+            context.forget(self.full_table_name)
+        caches = self._table_caches()
+        if not caches:
+            return
+        current = Transaction.current(self.__database__)
+        for cache in caches:
+            cache.invalidate()
+            if current is not None:
+                current.after_commit(cache.invalidate)
+
+    def _loader(self, row_format):
+        """The loader of the request to get rows through, see ``lian.orm.loader``"""
+        context = loader.current()
+        if context is None or row_format == 'tuple' or Transaction.current(self.__database__) is not None:
+            return None
+        return context
+
+    def get(self, pk, key=None, row_format=None):
+        """
+        In a loader context (``lian.orm.loader.request()``), the rows are kept, and the gets of the threads are
+        batched into one query.
+        """
         if not key:
             key = self.__pk__
-        rows = self.select(conditions={key: pk})
-        if not rows:
+        row_format = row_format or self.__row_format__
+        context = self._loader(row_format)
+        if context is not None:
+            row = context.load(self, key, pk, row_format)
+        else:
+            rows = self.select(conditions={key: pk}, limit=1, row_format=row_format)
+            row = rows[0] if rows else None
+        if row is None:
             raise ObjectNotFound('%s #%s' % (self.full_table_name, pk))
-        return rows[0]
-
-    def select(self, fields=None, conditions=None, limit=None, offset=None, order_by=None, group_by=None, raw_sql=None):
+        return row
+
+    def select(self, fields=None, conditions=None, limit=None, offset=None, order_by=None, group_by=None, raw_sql=None,
+               row_format=None, joins=None, alias=None, raise_error=False):
+        """
+        A select of a sharded model over several shards is run on all of them in parallel, then the rows are
+        merged in the order of ``order_by`` (selected for the merging if missing in ``fields``, but not returned),
+        ``group_by`` is not supported.
+
+        :param row_format: dict, tuple, namedtuple or slots (see ``lian.orm.rows``), default to ``__row_format__``
+        :param joins: ``statement.Join`` list, with the fields qualified by the aliases of the tables, e.g.
+                      ``User().select(['u.id', 'o.amount'], alias='u', joins=[Join(Order().sql, {'o.user_id':
+                      Column('u.id')}, alias='o')])``
+        :param alias: alias of the table of the model
+        :param raise_error: raise the exception of the query instead of returning no rows
+        """
+        models = self.route(conditions) if not raw_sql else None
+        if models is not None:
+            if len(models) == 1:
+                return models[0].select(fields, conditions, limit, offset, order_by, group_by, row_format=row_format,
+                                        joins=joins, alias=alias, raise_error=raise_error)
+            if group_by:
+                raise Exception('select over shards of %s does not support group_by' % self.__class__.__name__)
+            shard_limit = None if limit is None else limit + (offset or 0)
+
+            def _select_shards(shard_fields, shard_format):
+                return self._scatter(models, 'select', shard_fields, conditions, shard_limit, None, order_by,
+                                     row_format=shard_format, joins=joins, alias=alias, raise_error=raise_error)
+
+            return self._merge_select(_select_shards, fields, order_by, offset, limit, row_format)
+
+        large_in = self._large_in(conditions) if not raw_sql and not joins else None
+        if large_in is not None:
+            rows = self._select_large_in(large_in[0], large_in[1], fields, conditions, limit, offset, order_by,
+                                         group_by, row_format, raise_error, alias)
+            if rows is not None:
+                return rows
+
+        sql = raw_sql or self.sql.select(fields, conditions, limit, offset, order_by, group_by, joins, alias)
+        rows = self._query(sql, row_format or self.__row_format__, cached=not joins and not has_subquery(conditions),
+                           raise_error=raise_error)
+        return rows if rows is not None else []
+
+    def iter_select(self, fields=None, conditions=None, limit=None, offset=None, order_by=None, group_by=None,
+                    raw_sql=None, batch_size=None, row_format=None):
+        """Like ``select``, but a generator streaming the rows (or lists of rows if ``batch_size``)
+
+        The shards of a sharded model are streamed one after another, the rows are ordered in each shard only.
+        """
+        models = self.route(conditions) if not raw_sql else None
+        if models is not None:
+            return itertools.chain.from_iterable(
+                model.iter_select(fields, conditions, limit, offset, order_by, group_by, batch_size=batch_size,
+                                  row_format=row_format) for model in models)
         sql = raw_sql or self.sql.select(fields, conditions, limit, offset, order_by, group_by)
-        result = query(sql, db=self.__database__)
-        return result['rows'] if result else []
-
-    def find(self, fields=None, conditions=None, offset=None, order_by=None, raw_sql=None):
-        count = self.count(conditions=conditions)
-        if count == 0:
-            return None
-        rows = self.select(fields, conditions, limit=1, offset=offset, order_by=order_by, raw_sql=raw_sql)
-        return rows[0]
+        return iter_query(sql, batch_size=batch_size, db=self.__database__,
+                          row_format=row_format or self.__row_format__, row_name=self.row_name)
+
+    def select_columns(self, fields=None, conditions=None, limit=None, offset=None, order_by=None, group_by=None,
+                       raw_sql=None, batch_size=row_formats.COLUMNS_BATCH_SIZE, use_numpy=None):
+        """Like ``select``, but returns the columns: {field: array}, see ``query_columns``"""
+        model = self._single_shard(conditions) if not raw_sql else self
+        sql = raw_sql or model.sql.select(fields, conditions, limit, offset, order_by, group_by)
+        return query_columns(sql, db=model.__database__, batch_size=batch_size, use_numpy=use_numpy)
+
+    def paginate(self, limit, cursor=None, keys=None, fields=None, conditions=None):
+        """Keyset pagination, every page costs the same no matter how deep it is
+
+        :param limit: page size
+        :param cursor: the opaque token returned with the previous page, ``None`` for the first page
+        :param keys: the ordering key(s), default to the primary key, see ``statement.SQL.select_after``
+        :return: (rows, cursor of the next page or ``None`` if this is the last page)
+        """
+        model = self._single_shard(conditions)
+        keys = keys or self.__pk__
+        if isinstance(keys, str):
+            keys = [keys]
+        names = [key.lstrip('-') for key in keys]
+        if fields:
+            fields = list(fields) + [name for name in names if name not in fields]
+        after = decode_cursor(cursor) if cursor else None
+        sql = model.sql.select_after(keys, after, fields=fields, conditions=conditions, limit=limit)
+        rows = model.select(raw_sql=sql, row_format='dict', raise_error=True)  # not taken as the last page
+        if len(rows) < limit:
+            return rows, None
+        return rows, encode_cursor([rows[-1][name] for name in names])
+
+    def find(self, fields=None, conditions=None, offset=None, order_by=None, raw_sql=None, row_format=None):
+        """The first row (``LIMIT 1``), None if not found"""
+        rows = self.select(fields, conditions, limit=1, offset=offset, order_by=order_by, raw_sql=raw_sql,
+                           row_format=row_format)
+        return rows[0] if rows else None
+
+    def first_or_none(self, conditions=None, order_by=None, fields=None, row_format=None):
+        """``Model().first_or_none({'name': name}, order_by='-id')``, see ``find``"""
+        return self.find(fields, conditions, order_by=order_by, row_format=row_format)
+
+    def exists(self, conditions=None):
+        """Whether a row matches the conditions, without counting all of them"""
+        models = self.route(conditions)
+        if models is not None:
+            return any(self._scatter(models, 'exists', conditions))
+        rows = self._query(self.sql.exists(conditions), 'tuple', cached=not has_subquery(conditions))
+        return bool(rows and rows[0][0])
 
     def insert(self, values, fields=None, mode='insert',
                update=None,  # mode = update
                conditions=None,  # mode = insert-not-exists
                refetch=False):
         if not fields:
-            fields = self.__fields__
+            fields = self._meta.fields
+        if self.__shards__:
+            key_value = values[self.__shard_key__] if isinstance(values, dict) else \
+                values[list(fields).index(self.__shard_key__)]
+            return self.shard(key_value).insert(values, fields, mode, update, conditions, refetch)
         sql = self.sql.insert(values, fields=fields, mode=mode, update=update, conditions=conditions)
         result = execute(sql, auto_commit=True, db=self.__database__)
+        self._invalidate()
         if not result:
             self.logger.warning('insert return %s: %s', result, sql)
             return None
-        return self.get(result['lastrowid']) if refetch else result['lastrowid']
+        if not refetch:
+            return result['lastrowid']
+        # from the primary, the replicas may not have the row yet
+        sql = self.sql.select(conditions={self.__pk__: result['lastrowid']}, limit=1)
+        rows = self._query(sql, self.__row_format__, replica=False)
+        if not rows:
+            raise ObjectNotFound('%s #%s' % (self.full_table_name, result['lastrowid']))
+        return rows[0]
 
-    def insert_many(self, fields, values_list, update_fields=None):
+    def insert_many(self, fields, values_list, update_fields=None,
+                    max_rows=statement.INSERT_MANY_MAX_ROWS, max_bytes=statement.INSERT_MANY_MAX_BYTES, parallel=1):
+        """Bulk insert, split into statements of at most ``max_rows`` rows and ``max_bytes`` bytes, committed
+        one by one, on ``parallel`` pooled connections at the same time
+
+        :return: None if all the statements failed, else
+                 {
+                     'rows': None,
+                     'description': None,
+                     'rowcount': 500,  # sum of all the statements
+                     'lastrowid': 316613,  # of the last succeeded statement
+                     'lastrowids': [316113, None, 316613],  # of every statement, None if failed
+                     'errors': [{'chunk': 1, 'rows': 1000, 'error': OperationalError(...)}],
+                 }
+        """
         if not fields:
-            fields = self.__fields__
-        sql = self.sql.insert_many(fields, values_list, update_fields)
-        result = execute(sql, auto_commit=True, db=self.__database__)
-        if not result:
-            self.logger.warning('insert return %s: %s', result, sql)
+            fields = self._meta.fields
+        if self.__shards__:
+            return self._insert_many_shards(fields, values_list, update_fields, max_rows, max_bytes, parallel)
+        chunks = list(self.sql.insert_many_chunks(fields, values_list, update_fields, max_rows, max_bytes))
+
+        def _insert(chunk):
+            try:
+                if self.sql.parameterized:
+                    return execute_many(*chunk[0], auto_commit=True, db=self.__database__, raise_error=True), None
+                return execute(chunk[0], auto_commit=True, db=self.__database__, raise_error=True), None
+            except Exception as e:
+                return None, e
+
+        workers = parallel if Transaction.current(self.__database__) is None else 1
+        results = self._parallel([functools.partial(_insert, chunk) for chunk in chunks], workers)
+        if workers > 1 and len(chunks) > 1:
+            self._mark_write([self])  # written by the threads of the executor
+        self._invalidate()
+
+        result = {'rows': None, 'description': None, 'rowcount': 0, 'lastrowid': None, 'lastrowids': [], 'errors': []}
+        for i, ((_, rows), (chunk_result, error)) in enumerate(zip(chunks, results)):
+            if error is not None:
+                self.logger.warning('insert chunk #%d (%d rows) of %s failed: %s', i, rows, self.full_table_name, error)
+                result['errors'].append({'chunk': i, 'rows': rows, 'error': error})
+                result['lastrowids'].append(None)
+                continue
+            result['rowcount'] += chunk_result['rowcount']
+            result['lastrowid'] = chunk_result['lastrowid']
+            result['lastrowids'].append(chunk_result['lastrowid'])
+        if chunks and len(result['errors']) == len(chunks):
             return None
 
-        # {
-        #     'rows': None,
-        #     'conn': <lian.orm.db.PooledConnection object at 0x7fae315a17f0>,
-        #     'rowcount': 500,
-        #     'description': None,
-        #     'lastrowid': 316613
-        # }
         excepted_rows = len(values_list)
         if result['rowcount'] != excepted_rows:
             self.logger.warning('insert %s rows (excepted: %s)', result['rowcount'], excepted_rows)
         return result
 
+    def _insert_many_shards(self, fields, values_list, update_fields, max_rows, max_bytes, parallel):
+        index = list(fields).index(self.__shard_key__)
+        groups = collections.OrderedDict()
+        for values in values_list:
+            groups.setdefault(type(self).__shard_router__(values[index], self.__shards__), []).append(values)
+        result = {'rows': None, 'description': None, 'rowcount': 0, 'lastrowid': None, 'lastrowids': [], 'errors': []}
+        failed = 0
+        for db, shard_values_list in groups.items():
+            shard_result = self.using(db).insert_many(fields, shard_values_list, update_fields, max_rows, max_bytes,
+                                                      parallel)
+            if shard_result is None:
+                failed += 1
+                result['errors'].append({'shard': db, 'rows': len(shard_values_list), 'error': None})
+                continue
+            result['rowcount'] += shard_result['rowcount']
+            result['lastrowid'] = shard_result['lastrowid']
+            result['lastrowids'].extend(shard_result['lastrowids'])
+            result['errors'].extend([dict(error, shard=db) for error in shard_result['errors']])
+        if groups and failed == len(groups):
+            return None
+        return result
+
     def update(self, values, conditions=None):
+        models = self.route(conditions)
+        if models is not None:
+            rowcount = sum(self._scatter(models, 'update', values, conditions))
+            self._mark_write(models)
+            return rowcount
         sql = self.sql.update(values, conditions=conditions)
         result = execute(sql, auto_commit=True, db=self.__database__)
+        self._invalidate()
         return result['rowcount']  # 影响行数
 
+    def update_many(self, rows, key='id', fields=None, max_rows=statement.UPDATE_MANY_MAX_ROWS):
+        """Update the rows to different values, by ``CASE key WHEN ...`` statements of at most ``max_rows`` rows
+
+            Item().update_many([{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}])
+
+        :param rows: dicts of the key and the fields, the shard key too if the model is sharded
+        :param fields: default to the fields of the first row except the key
+        :return: affected rows count, the exception of a failed statement is raised (the previous ones are
+                 committed)
+        """
+        rows = list(rows)
+        if self.__shards__:
+            groups = collections.OrderedDict()
+            for row in rows:
+                groups.setdefault(type(self).__shard_router__(row[self.__shard_key__], self.__shards__), []).append(row)
+            return sum([self.using(db).update_many(shard_rows, key, fields, max_rows)
+                        for db, shard_rows in groups.items()])
+        rowcount = 0
+        try:
+            for sql, _ in self.sql.update_many_chunks(rows, key, fields, max_rows):
+                rowcount += execute(sql, auto_commit=True, db=self.__database__, raise_error=True)['rowcount']
+        finally:
+            self._invalidate()  # the chunks before a failed one are committed
+        return rowcount
+
     def count(self, conditions=None):
+        models = self.route(conditions)
+        if models is not None:
+            return sum(self._scatter(models, 'count', conditions))
+        large_in = self._large_in(conditions)
+        if large_in is not None:
+            calls = [functools.partial(self.count, chunk) for chunk in self._in_chunks(conditions, *large_in)]
+            return sum(self._parallel(calls, self._in_workers()))
         sql = self.sql.count(conditions)
-        result = query(sql, db=self.__database__)
-        return result['rows'][0]['COUNT(1)'] if result else 0
+        rows = self._query(sql, 'tuple', cached=not has_subquery(conditions))
+        return rows[0][0] if rows else 0
 
     def delete(self, conditions=None):
+        models = self.route(conditions)
+        if models is not None:
+            rowcount = sum(self._scatter(models, 'delete', conditions))
+            self._mark_write(models)
+            return rowcount
         sql = self.sql.delete(conditions)
         result = execute(sql, auto_commit=True, db=self.__database__)
+        self._invalidate()
         return result['rowcount']  # 影响行数
+
+    # Awaitable counterparts, for asyncio / Tornado coroutines: ``rows = await Model().aselect(...)``
+
+    def _submit(self, method, *args, **kwargs):
+        return ConnectionPool.instance().submit(self.__database__, functools.partial(method, *args, **kwargs))
+
+    def _submit_write(self, method, *args, **kwargs):
+        # marked in the context of the caller, the executor runs a copy of it
+        self._mark_write([self])
+        return self._submit(method, *args, **kwargs)
+
+    def aget(self, pk, key=None, row_format=None):
+        """In a loader context, the gets of the same tick are batched into one query"""
+        context = self._loader(row_format or self.__row_format__)
+        if context is None:
+            return self._submit(self.get, pk, key=key, row_format=row_format)
+        return self._aget_loaded(context, pk, key or self.__pk__, row_format or self.__row_format__)
+
+    async def _aget_loaded(self, context, pk, key, row_format):
+        row = await context.aload(self, key, pk, row_format)
+        if row is None:
+            raise ObjectNotFound('%s #%s' % (self.full_table_name, pk))
+        return row
+
+    def aselect(self, *args, **kwargs):
+        return self._submit(self.select, *args, **kwargs)
+
+    def afind(self, *args, **kwargs):
+        return self._submit(self.find, *args, **kwargs)
+
+    def afirst_or_none(self, *args, **kwargs):
+        return self._submit(self.first_or_none, *args, **kwargs)
+
+    def aexists(self, conditions=None):
+        return self._submit(self.exists, conditions=conditions)
+
+    def ainsert(self, *args, **kwargs):
+        return self._submit_write(self.insert, *args, **kwargs)
+
+    def ainsert_many(self, *args, **kwargs):
+        return self._submit_write(self.insert_many, *args, **kwargs)
+
+    def aupdate(self, values, conditions=None):
+        return self._submit_write(self.update, values, conditions=conditions)
+
+    def aupdate_many(self, *args, **kwargs):
+        return self._submit_write(self.update_many, *args, **kwargs)
+
+    def acount(self, conditions=None):
+        return self._submit(self.count, conditions=conditions)
+
+    def adelete(self, conditions=None):
+        return self._submit_write(self.delete, conditions=conditions)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Request-scoped batch loader and identity map of ``BASE.get``
+
+In a loader context, the rows got are kept (the same objects are returned again, writes to the table
+forget them), and the gets of different pks are batched into one ``WHERE pk IN (...)`` query:
+
+- ``aget`` called in the same tick of the IOLoop (e.g. ``await asyncio.gather(...)``), or
+- ``get`` called by the threads sharing the context (executor threads...) within ``window`` seconds,
+  the first get of a batch waits that long for the others, 0 (default): no waiting
+
+    from lian.orm import loader
+
+    class BaseHandler(tornado.web.RequestHandler):
+        async def _execute(self, *args, **kwargs):
+            with loader.request():
+                return await super(BaseHandler, self)._execute(*args, **kwargs)
+
+    users = await asyncio.gather(*[User().aget(order['user_id']) for order in orders])  # one query
+
+Out of a loader context, or in a transaction, ``get`` queries as usual.
+"""
+
+from __future__ import absolute_import, print_function
+
+import asyncio
+import contextlib
+import contextvars
+import threading
+import time
+
+DEFAULT_WINDOW = 0  # seconds
+
+_current = contextvars.ContextVar('lian.orm.loader', default=None)
+
+
+def _row_key(row, key):
+    return row[key] if isinstance(row, dict) else getattr(row, key)
+
+
+class _Batch(object):
+    __slots__ = ('pks', 'event', 'rows', 'error')
+
+    def __init__(self):
+        self.pks = {}  # pk => None, ordered
+        self.event = threading.Event()
+        self.rows = None
+        self.error = None
+
+
+class Loader(object):
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.rows = {}  # (db, table, key, row format) => {pk: row or None}, the identity map
+        self.batches = {}  # (db, table, key, row format) => _Batch, of the threads
+        self.pending = {}  # (db, table, key, row format) => {pk: [futures]}, of the IOLoop
+
+    @staticmethod
+    def _group(model, key, row_format):
+        return model.__database__, model.full_table_name, key, row_format
+
+    def _lookup(self, group, pk):
+        """(found, row or None)"""
+        with self.lock:
+            rows = self.rows.get(group)
+            if rows is not None and pk in rows:
+                return True, rows[pk]
+        return False, None
+
+    def _fetch(self, model, key, pks, row_format, group):
+        """The rows of the pks, kept in the identity map, a failed query raises and keeps nothing"""
+        found = {}
+        for row in model.select(conditions={key: pks}, row_format=row_format, raise_error=True):
+            found[_row_key(row, key)] = row
+        by_str = None
+        rows = {}
+        for pk in pks:
+            row = found.get(pk)
+            if row is None:  # e.g. a string pk from the URL, of an integer column
+                if by_str is None:
+                    by_str = {str(k): value for k, value in found.items()}
+                row = by_str.get(str(pk))
+            rows[pk] = row
+        with self.lock:
+            self.rows.setdefault(group, {}).update(rows)
+        return rows
+
+    def load(self, model, key, pk, row_format):
+        """The row of the pk, None if not found"""
+        group = self._group(model, key, row_format)
+        with self.lock:
+            rows = self.rows.get(group)
+            if rows is not None and pk in rows:
+                return rows[pk]
+            batch = self.batches.get(group)
+            leader = batch is None
+            if leader:
+                batch = self.batches[group] = _Batch()
+            batch.pks[pk] = None
+
+        if not leader:
+            batch.event.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.rows.get(pk)
+
+        if self.window:
+            time.sleep(self.window)
+        with self.lock:
+            del self.batches[group]  # the batch is closed
+        try:
+            batch.rows = self._fetch(model, key, list(batch.pks), row_format, group)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            batch.event.set()
+        return batch.rows.get(pk)
+
+    def aload(self, model, key, pk, row_format):
+        """An asyncio future of the row of the pk (None if not found), the pks of the same tick are batched"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        group = self._group(model, key, row_format)
+        found, row = self._lookup(group, pk)
+        if found:
+            future.set_result(row)
+            return future
+        pending = self.pending.get(group)
+        if pending is None:
+            pending = self.pending[group] = {}
+            loop.call_soon(self._flush, model, key, row_format, group)
+        pending.setdefault(pk, []).append(future)
+        return future
+
+    def _flush(self, model, key, row_format, group):
+        pending = self.pending.pop(group)
+
+        def _done(task):
+            error = task.exception()
+            for pk, futures in pending.items():
+                for future in futures:
+                    if future.done():
+                        continue
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(task.result().get(pk))
+
+        task = model._submit(self._fetch, model, key, list(pending), row_format, group)
+        task.add_done_callback(_done)
+
+    def forget(self, table):
+        """Drop the rows of the table (full name), after it is written"""
+        with self.lock:
+            for group in [group for group in self.rows if group[1] == table]:
+                del self.rows[group]
+
+
+def current():
+    """The loader of the current request, None out of a loader context"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def request(window=DEFAULT_WINDOW):
+    """A loader for the gets in the context, see the module doc"""
+    loader = Loader(window)
+    token = _current.set(loader)
+    try:
+        yield loader
+    finally:
+        _current.reset(token)
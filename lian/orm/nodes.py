@@ -5,6 +5,7 @@
 
 逻辑关系：[] 表示 OR；()，{} 表示 AND
 运算符：支持 is null，like，比较运算等
+字段：`u.id` 表示表（别名）u 的字段 id；值可以是 Column('o.user_id')（比较两个字段，用于 JOIN）或 Subquery（子查询）
 其他：字段与值都经过转义，避免注入
 """
 
@@ -15,6 +16,8 @@ import six
 import pymysql
 
 LOG = logging.getLogger(__name__)
+LIKE_PATTERNS = {'like': '%%%s%%', 'startswith': '%s%%', 'endswith': '%%%s'}
+PARAM_MARK = '\x00'  # a parameter while building a template, never in the escaped strings (\0 is escaped)
 
 
 def escaped_str(_str):
@@ -26,79 +29,164 @@ def escaped_var(_var):
     return pymysql.converters.escape_item(_var, 'utf-8')
 
 
+def quote_field(field):
+    """`field`, or `table`.`field` / `table`.* if qualified by the table (alias)"""
+    if '.' not in field:
+        return '`%s`' % field
+    table, name = field.split('.', 1)
+    return '`%s`.%s' % (table, '*' if name == '*' else '`%s`' % name)
+
+
+class Column(object):
+    """A column as the value of a condition, e.g. the conditions of a join: ``{'o.user_id': Column('u.id')}``"""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Column(%r)' % self.name
+
+
+class Subquery(object):
+    """A SELECT as the value of a condition: ``{'id__in': SQL('orders').subquery(['user_id'], {...})}``
+
+    :param sql: built with ``PARAM_MARK`` for the params, see ``template``
+    """
+
+    __slots__ = ('sql', 'params')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+
+    def __repr__(self):
+        return 'Subquery(%r, %r)' % (self.sql, self.params)
+
+
+def sql_var(_var, params=None):
+    """The escaped value, or placeholder(s) if the parameters are collected into ``params``"""
+    if isinstance(_var, Column):
+        return quote_field(escaped_str(_var.name))
+    if isinstance(_var, Subquery):
+        if params is None:
+            return '(%s)' % literal(template(_var.sql), _var.params)
+        params.extend(_var.params)
+        return '(%s)' % _var.sql
+    if params is None:
+        return escaped_var(_var)
+    if isinstance(_var, (list, tuple, set, frozenset)):
+        params.extend(_var)
+        return '(%s)' % ','.join([PARAM_MARK] * len(_var))  # as pymysql escapes the sequences
+    params.append(_var)
+    return PARAM_MARK
+
+
+def collect_var(_var, params):
+    """Collect the value into ``params`` as ``sql_var`` does, returns what its placeholders depend on"""
+    if isinstance(_var, Column):
+        return 'column', _var.name
+    if isinstance(_var, Subquery):
+        params.extend(_var.params)
+        return 'subquery', _var.sql
+    if isinstance(_var, (list, tuple, set, frozenset)):
+        params.extend(_var)
+        return len(_var)
+    params.append(_var)
+    return None
+
+
+def template(sql):
+    """The SQL built with ``PARAM_MARK`` as a pymysql query template: ``cursor.execute(template, params)``"""
+    return sql.replace('%', '%%').replace(PARAM_MARK, '%s')
+
+
+def literal(sql_template, params):
+    """The SQL of a template with the parameters escaped, as pymysql does"""
+    return sql_template % tuple([escaped_var(param) for param in params])
+
+
+def parse_condition(key, value):
+    """(field, expression, value) of an item of dict conditions"""
+    if value is None:
+        return key, 'is_null', True
+    parts = key.split('__')
+    if len(parts) == 2 and callable(getattr(SQLNode, '_exp_' + parts[1], None)):
+        return parts[0], parts[1], value
+    if isinstance(value, (list, tuple, set)):
+        return key, 'in', list(value)
+    return key, None, value
+
+
 class SQLNode(object):
-    def __init__(self, key, value):
+    def __init__(self, key, value, params=None):
         self.key_orig = key
-        if value is None:
-            self.key = key
-            self.exp = 'is_null'
-            self.value = True
-        else:
-            parts = key.split('__')
-            if len(parts) == 2 and callable(getattr(self, '_exp_' + parts[1], None)):
-                self.key, self.exp = parts
-                self.value = value
-            else:
-                self.key = key
-                if isinstance(value, (list, tuple, set)):
-                    self.exp = 'in'
-                    self.value = list(value)
-                else:
-                    self.exp = None
-                    self.value = value
+        self.params = params  # the values are collected into it when rendered, instead of being escaped
+        self.key, self.exp, self.value = parse_condition(key, value)
 
     @property
     def escaped_value(self):
-        return escaped_var(self.value)
+        return sql_var(self.value, self.params)
 
     @property
     def escaped_key(self):
         return escaped_str(self.key)
 
+    @property
+    def quoted_key(self):
+        return quote_field(self.escaped_key)
+
     @property
     def escaped_value_str(self):
         return escaped_str(self.value)
 
     def _exp_nq(self):
-        return "`%s` != %s" % (self.escaped_key, self.escaped_value)
+        return "%s != %s" % (self.quoted_key, self.escaped_value)
+
+    def _like(self, pattern):
+        if self.params is None:
+            return "%s LIKE '%s'" % (self.quoted_key, pattern % self.escaped_value_str)
+        return '%s LIKE %s' % (self.quoted_key, sql_var(pattern % self.value, self.params))
 
     def _exp_like(self):
-        return "`%s` LIKE '%%%s%%'" % (self.escaped_key, self.escaped_value_str)
+        return self._like(LIKE_PATTERNS['like'])
 
     def _exp_startswith(self):
-        return "`%s` LIKE '%s%%'" % (self.escaped_key, self.escaped_value_str)
+        return self._like(LIKE_PATTERNS['startswith'])
 
     def _exp_endswith(self):
-        return "`%s` LIKE '%%%s'" % (self.escaped_key, self.escaped_value_str)
+        return self._like(LIKE_PATTERNS['endswith'])
 
     def _exp_lt(self):
-        return '`%s` < %s' % (self.escaped_key, self.escaped_value)
+        return '%s < %s' % (self.quoted_key, self.escaped_value)
 
     def _exp_lte(self):
-        return '`%s` <= %s' % (self.escaped_key, self.escaped_value)
+        return '%s <= %s' % (self.quoted_key, self.escaped_value)
 
     def _exp_gt(self):
-        return '`%s` > %s' % (self.escaped_key, self.escaped_value)
+        return '%s > %s' % (self.quoted_key, self.escaped_value)
 
     def _exp_gte(self):
-        return '`%s` >= %s' % (self.escaped_key, self.escaped_value)
+        return '%s >= %s' % (self.quoted_key, self.escaped_value)
 
     def _exp_in(self):
-        return '`%s` IN %s' % (self.escaped_key, self.escaped_value)
+        return '%s IN %s' % (self.quoted_key, self.escaped_value)
 
     def _exp_is_null(self):
-        return '`%s` IS %sNULL' % (self.escaped_key, '' if self.value else 'NOT ')
+        return '%s IS %sNULL' % (self.quoted_key, '' if self.value else 'NOT ')
 
     def _exp_between(self):
         assert isinstance(self.value, (list, tuple)) and len(self.value) == 2
-        return '`%s` BETWEEN %s AND %s' % (self.escaped_key, escaped_var(self.value[0]), escaped_var(self.value[1]))
+        return '%s BETWEEN %s AND %s' % (self.quoted_key, sql_var(self.value[0], self.params),
+                                         sql_var(self.value[1], self.params))
 
     def __str__(self):
         if self.exp:
             exp = getattr(self, '_exp_' + self.exp, None)
             if callable(exp):
                 return exp()
-        return '`%s` = %s' % (self.escaped_key, self.escaped_value)
+        return '%s = %s' % (self.quoted_key, self.escaped_value)
 
 
 class SQLNodeTree(object):
@@ -114,7 +202,11 @@ class SQLNodeTree(object):
         return '(' + (' %s ' % self.relation).join(str(i) for i in self.nodes) + ')'
 
 
-def make_tree(conditions, logger=LOG):
+def make_tree(conditions, logger=LOG, params=None):
+    """
+    :param params: a list collecting the values in the order of rendering (``str(tree)``, which must be done
+                   once), they are rendered as ``PARAM_MARK``, see ``template``
+    """
     logger.debug('make_tree: %r', conditions)
     if not conditions:
         return SQLNodeTree([])
@@ -125,7 +217,7 @@ def make_tree(conditions, logger=LOG):
     assert isinstance(conditions, (tuple, list, dict))
 
     if isinstance(conditions, dict):
-        nodes = [SQLNode(k, v) for k, v in conditions.items()]
+        nodes = [SQLNode(k, v, params) for k, v in conditions.items()]
         return SQLNodeTree(nodes)
 
     if isinstance(conditions, (list, tuple)):
@@ -133,11 +225,58 @@ def make_tree(conditions, logger=LOG):
         if reverse:
             conditions = conditions[1:]
         relation = 'AND' if isinstance(conditions, tuple) else 'OR'
-        return SQLNodeTree([make_tree(i) for i in conditions], relation=relation, reverse=reverse)
+        return SQLNodeTree([make_tree(i, logger, params) for i in conditions], relation=relation, reverse=reverse)
 
     raise Exception('make_tree error: condition type must be tuple, list, or dict, got %s' % type(conditions))
 
 
+def _node_shape(exp, value, params):
+    if exp == 'is_null':
+        return bool(value)
+    if exp in LIKE_PATTERNS:
+        params.append(LIKE_PATTERNS[exp] % value)
+        return None
+    if exp == 'between':
+        assert isinstance(value, (list, tuple)) and len(value) == 2
+        params.extend(value)
+        return None
+    return collect_var(value, params)
+
+
+def conditions_shape(conditions, params):
+    """What the template of the conditions depends on (hashable), without building the tree, their values are
+    collected into ``params`` in the order of the placeholders, as ``make_tree`` does when rendered"""
+    if not conditions:
+        return None
+
+    if isinstance(conditions, six.string_types):
+        return conditions
+
+    if isinstance(conditions, dict):
+        shape = []
+        for k, v in conditions.items():
+            field, exp, value = parse_condition(k, v)  # e.g. x__is_null: `x` IS NULL, or `x__is_null` if None
+            shape.append((k, field, exp, _node_shape(exp, value, params)))
+        return tuple(shape)
+
+    if isinstance(conditions, (list, tuple)):
+        reverse = conditions[0] == 'NOT'
+        if reverse:
+            conditions = conditions[1:]
+        return (isinstance(conditions, tuple), reverse) + tuple([conditions_shape(i, params) for i in conditions])
+
+    raise Exception('make_tree error: condition type must be tuple, list, or dict, got %s' % type(conditions))
+
+
+def has_subquery(conditions):
+    """Whether a value of the conditions is a ``Subquery``, i.e. the conditions read other tables"""
+    if isinstance(conditions, dict):
+        return any(isinstance(value, Subquery) for value in conditions.values())
+    if isinstance(conditions, (list, tuple)):
+        return any(has_subquery(i) for i in conditions)
+    return False
+
+
 def __test():
     print(make_tree({'a': 1}))
     print(make_tree({'a': []}))
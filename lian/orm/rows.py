@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Row formats of the query results
+
+dict:       {'id': 1, 'name': 'a'}, a new dict (and the keys) for every row, by pymysql DictCursor
+tuple:      (1, 'a'), as pymysql Cursor returns
+namedtuple: Row(id=1, name='a'), a tuple with attribute access
+slots:      Row(id=1, name='a'), an object of a generated class with ``__slots__``, mutable
+
+The namedtuple and slots classes are generated once for every (row format, name, columns), and they
+are picklable (for the redis query cache) as long as this module is importable.
+
+Columns: {'id': array([1, 2]), 'name': array(['a', 'b'], dtype=object)}, for analytical queries, see
+``ColumnsBuilder``.
+"""
+
+from __future__ import absolute_import, print_function
+
+import array
+import collections
+import keyword
+import threading
+
+from pymysql.constants import FIELD_TYPE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ROW_FORMATS = 'dict', 'tuple', 'namedtuple', 'slots'
+COLUMNS_BATCH_SIZE = 10000
+INT_TYPES = (FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.INT24, FIELD_TYPE.LONG, FIELD_TYPE.LONGLONG,
+             FIELD_TYPE.YEAR)
+FLOAT_TYPES = FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE
+FLOAT_EXACT_INT = 2 ** 53  # larger integers are rounded in float64
+
+_row_classes = {}  # (row_format, name, columns) => class
+_row_classes_lock = threading.Lock()
+
+
+def _field_names(columns):
+    """Columns like ``COUNT(1)`` are not valid attribute names, rename them as namedtuple does"""
+    names = []
+    for i, column in enumerate(columns):
+        if not column.isidentifier() or keyword.iskeyword(column) or column.startswith('_') or column in names:
+            column = '_%d' % i
+        names.append(column)
+    return tuple(names)
+
+
+def _make_row(row_format, name, columns, values):
+    return row_class(row_format, name, columns)(*values)
+
+
+def _reduce_row(row):
+    return _make_row, (row._row_format, row.__class__.__name__, row._columns, tuple(row))
+
+
+class SlotsRow(object):
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join(['%s=%r' % (field, getattr(self, field)) for field in self.__slots__]))
+
+    def _asdict(self):
+        return collections.OrderedDict(zip(self.__slots__, self))
+
+    __reduce__ = _reduce_row
+
+
+def row_class(row_format, name, columns):
+    key = (row_format, name, columns)
+    cls = _row_classes.get(key)
+    if cls is None:
+        with _row_classes_lock:
+            cls = _row_classes.get(key)
+            if cls is None:
+                attrs = {'__slots__': (), '_row_format': row_format, '_columns': columns, '__module__': __name__}
+                if row_format == 'namedtuple':
+                    attrs['__reduce__'] = _reduce_row
+                    cls = type(name, (collections.namedtuple(name, columns, rename=True),), attrs)
+                elif row_format == 'slots':
+                    attrs['__slots__'] = _field_names(columns)
+                    cls = type(name, (SlotsRow,), attrs)
+                else:
+                    raise Exception('error row format: %s' % row_format)
+                _row_classes[key] = cls
+    return cls
+
+
+def is_tuple_format(row_format):
+    """Whether the rows should be fetched by a tuple (not dict) cursor"""
+    if row_format not in ROW_FORMATS:
+        raise Exception('error row format: %s' % row_format)
+    return row_format != 'dict'
+
+
+def converter(description, row_format='dict', name='Row'):
+    """A function converting a row from the cursor to the row format, None if nothing to do"""
+    if row_format in ('dict', 'tuple'):
+        return None
+    cls = row_class(row_format, name, tuple(column[0] for column in description))
+    return cls._make if row_format == 'namedtuple' else (lambda values: cls(*values))
+
+
+def format_rows(rows, description, row_format='dict', name='Row'):
+    convert = converter(description, row_format, name)
+    if convert is None:
+        return rows if isinstance(rows, list) else list(rows)
+    return [convert(row) for row in rows]
+
+
+class ColumnsBuilder(object):
+    """Collect the tuple rows into typed columns, the types are inferred from ``cursor.description``:
+
+    integer:           int64 (``array('q')``), or float64 with NaN for NULL if the column is nullable
+    float, double:     float64 (``array('d')``), NaN for NULL
+    others (DECIMAL,   object (list), the values are kept as they are
+    strings, dates...)
+
+    A column falls back to object if a value does not fit (e.g. BIGINT UNSIGNED over int64, or an integer over
+    2 ** 53 in a nullable column, NULL is None then).
+    """
+
+    def __init__(self, description, use_numpy=None):
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        if self.use_numpy and numpy is None:
+            raise Exception('numpy is not installed')
+        self.names = [column[0] for column in description]
+        self.columns = []
+        self.nullable = []
+        self.float_ints = []  # integer columns stored as float64
+        for column in description:
+            type_code, null_ok = column[1], column[6]
+            self.float_ints.append(bool(null_ok) and type_code in INT_TYPES)
+            if type_code in INT_TYPES:
+                self.columns.append(array.array('d' if null_ok else 'q'))
+            elif type_code in FLOAT_TYPES:
+                self.columns.append(array.array('d'))
+            else:
+                self.columns.append([])
+            self.nullable.append(null_ok or type_code in FLOAT_TYPES)
+
+    def extend(self, rows):
+        for i, values in enumerate(zip(*rows)):
+            column = self.columns[i]
+            if isinstance(column, list):
+                column.extend(values)
+                continue
+            if self.float_ints[i] and any(value is not None and abs(value) > FLOAT_EXACT_INT for value in values):
+                self.columns[i] = [None if value != value else int(value) for value in column] + list(values)
+                continue
+            if self.nullable[i]:
+                values = [float('nan') if value is None else value for value in values]
+            size = len(column)
+            try:
+                column.extend(values)
+            except (TypeError, OverflowError):
+                self.columns[i] = column[:size].tolist() + list(values)
+
+    def build(self):
+        if not self.use_numpy:
+            return dict(zip(self.names, self.columns))
+        columns = {}
+        for name, column in zip(self.names, self.columns):
+            if isinstance(column, list):
+                columns[name] = numpy.empty(len(column), dtype=object)
+                columns[name][:] = column
+            else:
+                columns[name] = numpy.frombuffer(column, dtype='int64' if column.typecode == 'q' else 'float64')
+        return columns
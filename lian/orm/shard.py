@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Horizontal sharding of BASE models
+
+    class Order(BASE):
+        __shard_key__ = 'user_id'
+        __shards__ = ('orders0', 'orders1', 'orders2')  # names of db config
+        __shard_router__ = ModuloRouter()  # or ConsistentHashRouter(), RangeRouter([(10000, 'orders0'), ...])
+
+A router is a callable: router(key value, shards) => shard.
+"""
+
+from __future__ import absolute_import, print_function
+
+import bisect
+import hashlib
+import zlib
+
+import six
+
+CONSISTENT_HASH_REPLICAS = 100  # virtual nodes of every shard
+
+
+def _int_key(key):
+    if isinstance(key, six.integer_types):
+        return key
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    return zlib.crc32(key) & 0xffffffff
+
+
+class ModuloRouter(object):
+    """Integer keys modulo the shards count, other keys are hashed by CRC32 first"""
+
+    def __call__(self, key, shards):
+        return shards[_int_key(key) % len(shards)]
+
+
+class ConsistentHashRouter(object):
+    """Only about 1/n of the keys move when a shard is added"""
+
+    def __init__(self, replicas=CONSISTENT_HASH_REPLICAS):
+        self.replicas = replicas
+        self._rings = {}  # shards => (sorted hashes, shards of the hashes)
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def _ring(self, shards):
+        shards = tuple(shards)
+        ring = self._rings.get(shards)
+        if ring is None:
+            points = sorted((self._hash('%s#%d' % (shard, i)), shard)
+                            for shard in shards for i in range(self.replicas))
+            ring = self._rings[shards] = ([point[0] for point in points], [point[1] for point in points])
+        return ring
+
+    def __call__(self, key, shards):
+        hashes, ring_shards = self._ring(shards)
+        index = bisect.bisect(hashes, self._hash(str(key))) % len(hashes)
+        return ring_shards[index]
+
+
+class RangeRouter(object):
+    """Key ranges: [(upper bound exclusive, shard), ..., (None, shard)], sorted by the upper bound"""
+
+    def __init__(self, ranges):
+        assert ranges
+        self.bounds = [bound for bound, _ in ranges if bound is not None]
+        self.shards = [shard for _, shard in ranges]
+        assert len(self.bounds) in (len(self.shards), len(self.shards) - 1)
+
+    def __call__(self, key, shards):
+        index = bisect.bisect_right(self.bounds, key)
+        if index >= len(self.shards):
+            raise Exception('shard key %r out of range' % (key,))
+        return self.shards[index]
+
+
+def _sort_key(value):
+    # NULL comes first in ascending order, as MySQL does
+    return value is not None, value
+
+
+def merge_rows(rows_list, order_by=None, offset=None, limit=None):
+    """Merge the rows (dict, namedtuple or slots) of the shards, ordered by ``order_by`` (fields, ``-`` prefix:
+    descending), then apply the offset and limit"""
+    rows = [row for rows in rows_list for row in rows]
+    if isinstance(order_by, str):
+        order_by = [order_by]
+    for field in reversed(order_by or []):
+        desc = field.startswith('-')
+        name = (field[1:] if desc else field).rsplit('.', 1)[-1]  # the rows are keyed by the column names
+        rows.sort(key=lambda row: _sort_key(row[name] if isinstance(row, dict) else getattr(row, name)),
+                  reverse=desc)
+    if offset:
+        rows = rows[offset:]
+    if limit is not None:
+        rows = rows[:limit]
+    return rows
@@ -3,27 +3,33 @@
 
 from __future__ import absolute_import, print_function
 
+import collections
 import logging
 import re
 
 from cached_property import cached_property
 
-from lian.orm.nodes import escaped_str, escaped_var, make_tree
+from lian.orm.nodes import (PARAM_MARK, Column, Subquery, collect_var, conditions_shape, escaped_str, literal,
+                             make_tree, quote_field, sql_var, template)
 
 LOG = logging.getLogger(__name__)
+INSERT_MANY_MAX_ROWS = 1000
+INSERT_MANY_MAX_BYTES = 1024 * 1024  # far below the max_allowed_packet (4M of MySQL 5.7, 16M of pymysql)
+UPDATE_MANY_MAX_ROWS = 500  # every row is repeated in the CASE of every field
+TEMPLATES_CACHE_SIZE = 10000  # shapes of statements, the least recently used are evicted
 SET_OPS = 'ADD',
 RE_SET_OP = re.compile('^(%s):(.+)$' % ('|'.join(SET_OPS)))
 
 
-def _set_sql(values):
+def _set_sql(values, params=None):
     def _set_v(key, value):
         _re_op_result = RE_SET_OP.search(key)
         if _re_op_result:
             op, new_k = _re_op_result.groups()
             new_k = escaped_str(new_k)
             if op == 'ADD':
-                return '`%s` = `%s` + %s' % (new_k, new_k, escaped_var(value))
-        return '`%s` = %s' % (escaped_str(key), escaped_var(value))
+                return '`%s` = `%s` + %s' % (new_k, new_k, sql_var(value, params))
+        return '`%s` = %s' % (escaped_str(key), sql_var(value, params))
 
     return ', '.join([_set_v(k, v) for k, v in values.items()])
 
@@ -38,10 +44,10 @@ def _fields_sql(fields, select_mode=False):
         _re_func_result = RE_FUNC.search(field)
         if _re_func_result:
             func, field = _re_func_result.groups()
-            return '%s(`%s`)' % (func, escaped_str(field))
+            return '%s(%s)' % (func, quote_field(escaped_str(field)))
         if field.startswith('*'):
-            return 'DISTINCT `%s`' % field[1:]
-        return '`%s`' % field
+            return 'DISTINCT %s' % quote_field(field[1:])
+        return quote_field(field)
 
     def _inner(field):
         if select_mode:
@@ -57,11 +63,67 @@ def _fields_sql(fields, select_mode=False):
     return None
 
 
+_templates = collections.OrderedDict()  # (table, shape of the statement) => template, LRU
+
+
+def _shape(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _set_shape(values, params):
+    return tuple([(key, collect_var(value, params)) for key, value in values.items()])
+
+
 class SQL:
-    def __init__(self, table, database=None, logger=None):
+    """SQL builder of a table
+
+    The templates are compiled once for every shape of the statements (the fields, the condition keys and
+    operators, the lengths of the IN lists, the order / group by, if limit / offset is given...), then only
+    the values are escaped into them (or returned as params).
+
+    :param parameterized: the statements are returned as (template, params) for ``cursor.execute``, instead
+                          of SQL with the values escaped in, e.g.
+                          ``('SELECT * FROM `t` WHERE (`id` = %s)', [1])``, ``db.query`` / ``db.execute`` take
+                          them as they are
+    """
+
+    def __init__(self, table, database=None, logger=None, parameterized=False):
         self.database = database
         self.table = table
         self.logger = logger or LOG
+        self.parameterized = parameterized
+
+    def _where(self, conditions, params):
+        # rendered at once, so that the params are collected in order
+        return str(make_tree(conditions, self.logger, params))
+
+    def _compile(self, shape, params, build, *args):
+        """The statement of the template of the shape, built by ``build(params, *args)`` at the first time
+
+        :param params: the values of the statement, in the order of the placeholders
+        """
+        key = (self.sql_table, shape)
+        try:
+            sql_template = _templates.get(key)
+        except TypeError:  # e.g. lists in fields
+            key, sql_template = None, None
+        if sql_template is not None:
+            try:
+                _templates.move_to_end(key)
+            except KeyError:  # evicted by another thread meanwhile
+                pass
+        else:
+            sql_template = template(build([], *args))
+            if key is not None:
+                _templates[key] = sql_template
+                while len(_templates) > TEMPLATES_CACHE_SIZE:
+                    try:
+                        _templates.popitem(last=False)
+                    except KeyError:
+                        break
+        if self.parameterized:
+            return sql_template, params
+        return literal(sql_template, params)
 
     @cached_property
     def sql_table(self):
@@ -69,15 +131,42 @@ class SQL:
             return '`%s`.`%s`' % (self.database, self.table)
         return '`%s`' % self.table
 
-    def select(self, fields=None, conditions=None, limit=None, offset=None, order_by=None, group_by=None):
+    def select(self, fields=None, conditions=None, limit=None, offset=None, order_by=None, group_by=None,
+               joins=None, alias=None):
+        """
+        :param joins: ``Join`` list, the fields / conditions / order by of the joined tables are qualified by
+                      their aliases: ``u.name``, ``{'o.user_id': Column('u.id')}``...
+        :param alias: alias of the table
+        """
+        params = []
+        joins_shape = tuple([join.shape(params) for join in joins or ()])
+        shape = ('select', _shape(fields), conditions_shape(conditions, params), _shape(order_by), _shape(group_by),
+                 isinstance(limit, int), isinstance(offset, int), joins_shape, alias)
+        if isinstance(limit, int):
+            params.append(limit)
+        if isinstance(offset, int):
+            params.append(offset)
+        return self._compile(shape, params, self._select, fields, conditions, limit, offset, order_by, group_by,
+                             joins, alias)
+
+    def subquery(self, fields=None, conditions=None, limit=None, offset=None, order_by=None, group_by=None,
+                 joins=None, alias=None):
+        """The select as the value of a condition: ``{'id__in': orders.subquery(['user_id'], {'paid': 1})}``"""
+        params = []
+        sql = self._select(params, fields, conditions, limit, offset, order_by, group_by, joins, alias)
+        return Subquery(sql, params)
+
+    def _select(self, params, fields, conditions, limit, offset, order_by, group_by, joins=None, alias=None):
         fields_str = _fields_sql(fields, select_mode=True) or '*'
-        conditions_sql = make_tree(conditions, self.logger)
-        sql = 'SELECT %s FROM %s WHERE %s' % (fields_str, self.sql_table, conditions_sql)
+        table = self.sql_table if not alias else '%s AS `%s`' % (self.sql_table, escaped_str(alias))
+        table += ''.join([join.sql(params, self.logger) for join in joins or ()])
+        conditions_sql = self._where(conditions, params)
+        sql = 'SELECT %s FROM %s WHERE %s' % (fields_str, table, conditions_sql)
 
         if isinstance(group_by, (tuple, list, str)) and group_by:
             if isinstance(group_by, str):
                 group_by = [group_by]
-            sql += ' GROUP BY ' + (', '.join(['`%s`' % field for field in group_by]))
+            sql += ' GROUP BY ' + (', '.join([quote_field(field) for field in group_by]))
 
         if isinstance(order_by, str):
             order_by = [order_by]
@@ -89,18 +178,67 @@ class SQL:
         for i in order_by:
             assert isinstance(i, str) and i
             if i.startswith('-'):
-                i = '`%s` DESC' % escaped_str(i[1:])
+                i = '%s DESC' % quote_field(escaped_str(i[1:]))
             else:
-                i = '`%s`' % i
+                i = quote_field(i)
             _order_by_sql.append(i)
         if _order_by_sql:
             sql += ' ORDER BY %s' % (', '.join(_order_by_sql))
 
         if isinstance(limit, int):
-            sql += ' LIMIT %d' % limit
+            sql += ' LIMIT %s' % sql_var(limit, params)
 
         if isinstance(offset, int):
-            sql += ' OFFSET %d' % offset
+            sql += ' OFFSET %s' % sql_var(offset, params)
+
+        return sql
+
+    def select_after(self, keys, after=None, fields=None, conditions=None, limit=None):
+        """Keyset (seek) pagination, select the rows following ``after`` in the order of ``keys``
+
+        :param keys: the ordering key(s), unique together, all ascending or all descending (``-`` prefix)
+        :param after: values of ``keys`` of the last row of the previous page, ``None`` for the first page
+        """
+        if isinstance(keys, str):
+            keys = [keys]
+        assert keys and all(isinstance(key, str) and key for key in keys)
+        if after is not None and not isinstance(after, (list, tuple)):
+            after = [after]
+        assert after is None or len(after) == len(keys)
+
+        params = []
+        shape = ('select_after', tuple(keys), after is None, _shape(fields), conditions_shape(conditions, params),
+                 isinstance(limit, int))
+        if after is not None:
+            params.extend(after)
+        if isinstance(limit, int):
+            params.append(limit)
+        return self._compile(shape, params, self._select_after, keys, after, fields, conditions, limit)
+
+    def _select_after(self, params, keys, after, fields, conditions, limit):
+        desc = keys[0].startswith('-')
+        assert all(key.startswith('-') == desc for key in keys), 'keys must be in the same direction: %r' % keys
+        names = [key[1:] if desc else key for key in keys]
+
+        fields_str = _fields_sql(fields, select_mode=True) or '*'
+        conditions_tree = make_tree(conditions, self.logger, params)
+        conditions_sql = str(conditions_tree)
+
+        if after is not None:
+            keys_sql = ', '.join([quote_field(escaped_str(name)) for name in names])
+            values_sql = ', '.join([sql_var(value, params) for value in after])
+            if len(names) > 1:
+                keys_sql, values_sql = '(%s)' % keys_sql, '(%s)' % values_sql
+            if isinstance(conditions_tree, str):
+                conditions_sql = '(%s)' % conditions_sql
+            conditions_sql = '%s AND %s %s %s' % (conditions_sql, keys_sql, '<' if desc else '>', values_sql)
+
+        sql = 'SELECT %s FROM %s WHERE %s' % (fields_str, self.sql_table, conditions_sql)
+        sql += ' ORDER BY %s' % ', '.join(['%s%s' % (quote_field(escaped_str(name)), ' DESC' if desc else '')
+                                           for name in names])
+
+        if isinstance(limit, int):
+            sql += ' LIMIT %s' % sql_var(limit, params)
 
         return sql
 
@@ -111,18 +249,28 @@ class SQL:
             values = [values[i] for i in fields]
         else:
             assert len(values) == len(fields)
-        values_str = ', '.join([escaped_var(val) for val in values])
+
+        params = []
+        values_shape = tuple([collect_var(value, params) for value in values])
+        if mode != 'insert':
+            update = None  # only rendered by insert
+        update_shape = update if isinstance(update, str) or not update else _set_shape(update, params)
+        shape = ('insert', mode, tuple(fields), values_shape, update_shape, conditions_shape(conditions, params))
+        return self._compile(shape, params, self._insert, values, fields, mode, update, conditions)
+
+    def _insert(self, params, values, fields, mode, update, conditions):
+        values_str = ', '.join([sql_var(val, params) for val in values])
 
         if mode == 'insert':  # optional: update
             sql = 'INSERT INTO %s (%s) VALUES (%s)' % (self.sql_table, _fields_sql(fields), values_str)
             if update:
-                sql += ' ON DUPLICATE KEY UPDATE %s' % (update if isinstance(update, str) else _set_sql(update))
+                sql += ' ON DUPLICATE KEY UPDATE %s' % (update if isinstance(update, str) else _set_sql(update, params))
         elif mode == 'replace':
             sql = 'REPLACE INTO %s (%s) VALUES (%s)' % (self.sql_table, _fields_sql(fields), values_str)
         elif mode == 'insert-not-exists':  # must: conditions
             if not conditions:
                 raise Exception('insert(mode insert-not-exists): must has conditions param')
-            conditions_sql = make_tree(conditions, self.logger)
+            conditions_sql = self._where(conditions, params)
             sql = 'INSERT INTO %s (%s) SELECT * FROM (SELECT %s) AS tmp WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s) LIMIT 1' % (
                 self.sql_table, _fields_sql(fields), values_str, self.sql_table, conditions_sql)
         else:
@@ -131,29 +279,152 @@ class SQL:
         return sql
 
     def insert_many(self, fields, values_list, update_fields=None):
-        # ON DUPLICATE KEY UPDATE a_field = VALUES(a_field), date=VALUES(date)
-        values_str_list = []
+        """The bulk INSERT, or (template of a row, values_list) for ``db.execute_many`` if parameterized"""
+        for sql, _ in self.insert_many_chunks(fields, values_list, update_fields, max_rows=0, max_bytes=0):
+            return sql
+
+    def insert_many_chunks(self, fields, values_list, update_fields=None,
+                           max_rows=INSERT_MANY_MAX_ROWS, max_bytes=INSERT_MANY_MAX_BYTES):
+        """Split a bulk INSERT into statements of at most ``max_rows`` rows and ``max_bytes`` bytes (0: no limit),
+        a single row larger than ``max_bytes`` makes a statement on its own
+
+        If parameterized, the chunks are (template of a row, values_list) for ``db.execute_many``, split by
+        ``max_rows`` only: pymysql ``executemany`` rewrites them into bulk INSERT under its own size limit.
+
+        :return: generator of (sql, rows count)
+        """
+        head = 'INSERT INTO %s (%s) VALUES ' % (self.sql_table, _fields_sql(fields))
+        tail = ''
+        if update_fields:
+            # ON DUPLICATE KEY UPDATE a_field = VALUES(a_field), date=VALUES(date)
+            assert isinstance(update_fields, (list, tuple))
+            tail = ' ON DUPLICATE KEY UPDATE %s' % (', '.join(['`%s` = VALUES(`%s`)' % (f, f) for f in update_fields]))
+        if self.parameterized:
+            sql = template(head + '(%s)' % ', '.join([PARAM_MARK] * len(fields)) + tail)
+            values_list = list(values_list)
+            step = max_rows or len(values_list) or 1
+            for i in range(0, len(values_list), step):
+                chunk = values_list[i:i + step]
+                assert all(isinstance(values, (list, tuple)) and len(values) == len(fields) for values in chunk)
+                yield (sql, chunk), len(chunk)
+            return
+
+        base_size = len(head.encode('utf-8')) + len(tail.encode('utf-8'))
+
+        chunk, size = [], base_size
         for values in values_list:
             assert isinstance(values, (list, tuple))
             assert len(values) == len(fields)
-            values_str_list.append(', '.join([escaped_var(val) for val in values]))
-        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (self.sql_table, _fields_sql(fields), '), ('.join(values_str_list))
-        if update_fields:
-            assert isinstance(update_fields, (list, tuple))
-            sql += ' ON DUPLICATE KEY UPDATE %s' % (', '.join(['`%s` = VALUES(`%s`)' % (f, f) for f in update_fields]))
-        return sql
+            row = '(%s)' % ', '.join([sql_var(val) for val in values])
+            row_size = len(row.encode('utf-8')) + 2  # with the separator
+            if chunk and ((max_rows and len(chunk) >= max_rows) or (max_bytes and size + row_size > max_bytes)):
+                yield head + ', '.join(chunk) + tail, len(chunk)
+                chunk, size = [], base_size
+            chunk.append(row)
+            size += row_size
+        if chunk:
+            yield head + ', '.join(chunk) + tail, len(chunk)
 
     def update(self, values, conditions=None):
-        conditions_sql = make_tree(conditions, self.logger)
-        sql = 'UPDATE %s SET %s WHERE %s' % (self.sql_table, _set_sql(values), conditions_sql)
-        return sql
+        params = []
+        shape = ('update', _set_shape(values, params), conditions_shape(conditions, params))
+        return self._compile(shape, params, self._update, values, conditions)
+
+    def _update(self, params, values, conditions):
+        set_sql = _set_sql(values, params)
+        return 'UPDATE %s SET %s WHERE %s' % (self.sql_table, set_sql, self._where(conditions, params))
+
+    def update_many(self, rows, key='id', fields=None):
+        """Update the rows (dicts of ``key`` and ``fields``) to different values in one statement:
+        ``UPDATE t SET `f` = CASE `id` WHEN 1 THEN 'a' WHEN 2 THEN 'b' END WHERE `id` IN (1,2)``
+
+        :param fields: default to the fields of the first row except the key
+        """
+        for sql, _ in self.update_many_chunks(rows, key, fields, max_rows=0):
+            return sql
+
+    def update_many_chunks(self, rows, key='id', fields=None, max_rows=UPDATE_MANY_MAX_ROWS):
+        """Split a bulk update into statements of at most ``max_rows`` rows (0: no limit), the last row wins if
+        a key is duplicated
+
+        :return: generator of (sql, rows count)
+        """
+        rows = list(collections.OrderedDict([(row[key], row) for row in rows]).values())
+        if not rows:
+            return
+        if not fields:
+            fields = [field for field in rows[0] if field != key]
+        assert fields and key not in fields
+        fields = tuple(fields)
+        step = max_rows or len(rows)
+        for i in range(0, len(rows), step):
+            chunk = rows[i:i + step]
+            params = []
+            values_shape = tuple([(collect_var(row[key], params), collect_var(row[field], params))
+                                  for field in fields for row in chunk])
+            keys = [row[key] for row in chunk]
+            params.extend(keys)
+            shape = ('update_many', key, fields, values_shape)
+            yield self._compile(shape, params, self._update_many, chunk, key, fields, keys), len(chunk)
+
+    def _update_many(self, params, rows, key, fields, keys):
+        key_sql = quote_field(escaped_str(key))
+        cases = ', '.join(['%s = CASE %s %s END' % (
+            quote_field(escaped_str(field)), key_sql,
+            ' '.join(['WHEN %s THEN %s' % (sql_var(row[key], params), sql_var(row[field], params)) for row in rows]))
+            for field in fields])
+        return 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+            self.sql_table, cases, key_sql, ','.join([sql_var(value, params) for value in keys]))
 
     def count(self, conditions=None):
-        conditions_sql = make_tree(conditions, self.logger)
-        sql = 'SELECT COUNT(1) FROM %s WHERE %s' % (self.sql_table, conditions_sql)
-        return sql
+        params = []
+        shape = ('count', conditions_shape(conditions, params))
+        return self._compile(shape, params, self._count, conditions)
+
+    def _count(self, params, conditions):
+        return 'SELECT COUNT(1) FROM %s WHERE %s' % (self.sql_table, self._where(conditions, params))
+
+    def exists(self, conditions=None):
+        """``SELECT EXISTS(...)``: 1 or 0, stops at the first row found"""
+        params = []
+        shape = ('exists', conditions_shape(conditions, params))
+        return self._compile(shape, params, self._exists, conditions)
+
+    def _exists(self, params, conditions):
+        return 'SELECT EXISTS(SELECT 1 FROM %s WHERE %s)' % (self.sql_table, self._where(conditions, params))
 
     def delete(self, conditions=None):
-        conditions_sql = make_tree(conditions, self.logger)
-        sql = 'DELETE FROM %s WHERE %s' % (self.sql_table, conditions_sql)
-        return sql
+        params = []
+        shape = ('delete', conditions_shape(conditions, params))
+        return self._compile(shape, params, self._delete, conditions)
+
+    def _delete(self, params, conditions):
+        return 'DELETE FROM %s WHERE %s' % (self.sql_table, self._where(conditions, params))
+
+
+class Join(object):
+    """``INNER JOIN`` / ``LEFT JOIN`` of a select
+
+        users.select(['u.id', 'u.name', ('o.amount', 'amount')], {'u.status': 1}, alias='u',
+                     joins=[Join('orders', {'o.user_id': Column('u.id')}, alias='o', kind='left')])
+
+    :param table: name of the table, or the ``SQL`` of the table (e.g. ``Order().sql``, with the database)
+    :param on: conditions of the join, ``Column`` values compare the fields of the tables
+    """
+
+    KINDS = 'INNER', 'LEFT'
+
+    def __init__(self, table, on, alias=None, kind='INNER'):
+        assert on
+        self.kind = kind.upper()
+        assert self.kind in self.KINDS, 'kind of join should be one of %r' % (self.KINDS,)
+        self.table = table.sql_table if isinstance(table, SQL) else quote_field(escaped_str(table))
+        self.on = on
+        self.alias = alias
+
+    def shape(self, params):
+        return self.kind, self.table, self.alias, conditions_shape(self.on, params)
+
+    def sql(self, params, logger=LOG):
+        table = self.table if not self.alias else '%s AS `%s`' % (self.table, escaped_str(self.alias))
+        return ' %s JOIN %s ON %s' % (self.kind, table, make_tree(self.on, logger, params))
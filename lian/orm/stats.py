@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-statement statistics (like pg_stat_statements), in process
+
+The SQL are grouped by fingerprint: the literals (and the ``%s`` of the templates) are replaced with ``?``,
+the lists in ``IN (...)`` and the rows of ``VALUES (...), (...)`` are collapsed, so the statements of the
+same shape share one entry.
+
+    from lian.orm import stats
+    stats.enable()
+    ...
+    stats.STATS.snapshot(limit=10)  # the statements dominating the DB time
+    stats.STATS.dump_json('/tmp/sql-stats.json')
+"""
+
+from __future__ import absolute_import, print_function
+
+import collections
+import json
+import re
+import threading
+
+DEFAULT_SAMPLES = 1000  # latencies kept for the percentiles, the latest ones
+EXAMPLE_LENGTH = 1000
+
+RE_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+RE_NUMBER = re.compile(r'(?<![\w`.])[-+]?(?:0x[0-9a-fA-F]+|\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)\b')
+RE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+RE_ROWS = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+RE_SPACES = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    sql = RE_STRING.sub('?', sql)
+    sql = sql.replace('%s', '?')  # the placeholders of the templates
+    sql = RE_NUMBER.sub('?', sql)
+    sql = RE_LIST.sub('(?+)', sql)
+    sql = RE_ROWS.sub('(?+), ...', sql)
+    return RE_SPACES.sub(' ', sql).strip()
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class _Entry(object):
+    __slots__ = ('fingerprint', 'example', 'calls', 'errors', 'rows', 'slow', 'total_ms', 'min_ms', 'max_ms',
+                 'samples')
+
+    def __init__(self, fingerprint_, example, samples):
+        self.fingerprint = fingerprint_
+        self.example = example[:EXAMPLE_LENGTH]
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.slow = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = 0.0
+        self.samples = collections.deque(maxlen=samples)
+
+    def as_dict(self):
+        samples = sorted(self.samples)
+        return {
+            'fingerprint': self.fingerprint,
+            'example': self.example,
+            'calls': self.calls,
+            'errors': self.errors,
+            'rows': self.rows,
+            'slow': self.slow,
+            'total_ms': self.total_ms,
+            'mean_ms': self.total_ms / self.calls if self.calls else 0.0,
+            'min_ms': self.min_ms or 0.0,
+            'max_ms': self.max_ms,
+            'p95_ms': _percentile(samples, 95),
+            'p99_ms': _percentile(samples, 99),
+        }
+
+
+class StatementStats(object):
+    def __init__(self, samples=DEFAULT_SAMPLES):
+        self.enabled = False
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._entries = {}  # fingerprint => _Entry
+
+    def record(self, sql, elapsed_ms, rows=0, error=False, slow=False):
+        key = fingerprint(sql)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(key, sql, self.samples)
+            entry.calls += 1
+            entry.rows += rows
+            entry.total_ms += elapsed_ms
+            entry.samples.append(elapsed_ms)
+            if entry.min_ms is None or elapsed_ms < entry.min_ms:
+                entry.min_ms = elapsed_ms
+            if elapsed_ms > entry.max_ms:
+                entry.max_ms = elapsed_ms
+            if error:
+                entry.errors += 1
+            if slow:
+                entry.slow += 1
+
+    def get(self, sql):
+        """Statistics of the fingerprint of the SQL, None if never recorded"""
+        with self._lock:
+            entry = self._entries.get(fingerprint(sql))
+            return entry.as_dict() if entry else None
+
+    def snapshot(self, order_by='total_ms', limit=None):
+        with self._lock:
+            entries = [entry.as_dict() for entry in self._entries.values()]
+        entries.sort(key=lambda entry: entry[order_by], reverse=True)
+        return entries[:limit] if limit else entries
+
+    def dump_json(self, path=None, order_by='total_ms', limit=None):
+        """The snapshot as JSON, written into the file if ``path``"""
+        content = json.dumps(self.snapshot(order_by, limit), ensure_ascii=False, indent=2)
+        if path:
+            with open(path, 'w') as _file:
+                _file.write(content)
+        return content
+
+    def reset(self):
+        with self._lock:
+            self._entries = {}
+
+
+STATS = StatementStats()
+
+
+def enable():
+    STATS.enabled = True
+
+
+def disable():
+    STATS.enabled = False
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sampled query tracing
+
+The spans (acquire, ping, execute, fetch, commit) of the SQL run in a sampled request are collected, and
+exported as JSON lines when the request ends. Out of a sampled request, ``current()`` is None and the
+ORM does nothing more than checking it.
+
+    from lian.orm import trace
+    trace.configure(sample_rate=0.01, path='/var/log/app/sql-spans.jsonl')
+
+    class BaseHandler(tornado.web.RequestHandler):
+        async def _execute(self, *args, **kwargs):
+            with trace.request(self.request.headers.get('X-Request-Id')):
+                return await super(BaseHandler, self)._execute(*args, **kwargs)
+
+The request is carried by a contextvar, so it follows the coroutines, and the ``aquery`` / ``aselect``
+calls running in the executors.
+"""
+
+from __future__ import absolute_import, print_function
+
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+
+SQL_LENGTH = 1000
+
+LOG = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('lian.orm.trace', default=None)
+
+
+class _Config(object):
+    sample_rate = 0.0
+    path = None
+    exporter = None  # callable(spans), instead of writing into path
+    lock = threading.Lock()
+
+
+def configure(sample_rate=0.0, path=None, exporter=None):
+    """
+    :param sample_rate: ratio of the requests traced, 0 ~ 1
+    :param path: the JSON lines file the spans are appended to
+    :param exporter: callable(list of spans), instead of the file
+    """
+    assert 0 <= sample_rate <= 1
+    _Config.sample_rate = sample_rate
+    _Config.path = path
+    _Config.exporter = exporter
+
+
+class Trace(object):
+    __slots__ = ('request_id', 'spans')
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.spans = []
+
+    def add(self, name, started_at, db=None, sql=None, error=None, **attrs):
+        """Record a span started at ``started_at`` (timestamp) and ending now"""
+        span = {
+            'request_id': self.request_id,
+            'name': name,
+            'db': db,
+            'start': started_at,
+            'duration_ms': (time.time() - started_at) * 1000,
+        }
+        if sql is not None:
+            span['sql'] = sql[:SQL_LENGTH]
+        if error is not None:
+            span['error'] = str(error)
+        span.update(attrs)
+        self.spans.append(span)
+
+
+class _Span(object):
+    __slots__ = ('trace', 'name', 'db', 'sql', 'started_at')
+
+    def __init__(self, trace, name, db, sql):
+        self.trace = trace
+        self.name = name
+        self.db = db
+        self.sql = sql
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.add(self.name, self.started_at, db=self.db, sql=self.sql, error=exc_value)
+        return False
+
+
+_NOOP = contextlib.nullcontext()
+
+
+def current():
+    """The trace of the current request if it is sampled, else None"""
+    return _current.get()
+
+
+def span(name, db=None, sql=None):
+    """``with trace.span('execute', db, sql): ...``, a no-op context out of a sampled request"""
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, db, sql)
+
+
+def export(spans):
+    if not spans:
+        return
+    if _Config.exporter is not None:
+        _Config.exporter(spans)
+        return
+    if not _Config.path:
+        return
+    lines = ''.join([json.dumps(span, ensure_ascii=False, default=str) + '\n' for span in spans])
+    with _Config.lock:
+        with open(_Config.path, 'a') as _file:
+            _file.write(lines)
+
+
+@contextlib.contextmanager
+def request(request_id=None, sampled=None):
+    """Trace the SQL of a request if it is sampled
+
+    :param request_id: default to a random one
+    :param sampled: force (True) or skip (False) the tracing, default to sampling by ``sample_rate``
+    """
+    if sampled is None:
+        sampled = _Config.sample_rate > 0 and random.random() < _Config.sample_rate
+    if not sampled:
+        yield None
+        return
+
+    trace = Trace(request_id)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        try:
+            export(trace.spans)
+        except Exception as e:
+            LOG.exception('export spans of request %s failed: %s', trace.request_id, e)
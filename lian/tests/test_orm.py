@@ -0,0 +1,876 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import contextvars
+import datetime
+import decimal
+import json
+import pickle
+import threading
+import time
+
+import pymysql
+import pytest
+from pymysql.constants import CLIENT
+
+from lian.orm import db, loader, nodes, rows as row_formats, shard, statement, stats, trace
+
+
+class FakeCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = connection.description
+        self.lastrowid = connection.lastrowid
+        self.rowcount = -1
+        self.rows = []
+        self.pending = []  # the other statements of a multi-statement SQL
+
+    def execute(self, sql, args=None):
+        self.connection.executed.append(sql if args is None else (sql, args))
+        if self.connection.broken:
+            errno = 2006 if self.connection.broken is True else self.connection.broken
+            raise pymysql.err.OperationalError(errno, 'MySQL server has gone away')
+        if self.connection.client_flag & CLIENT.MULTI_STATEMENTS:
+            self.pending = sql.split(';\n')[1:]
+        return self._result()
+
+    def _result(self):
+        self.rows = list(self.connection.results.pop(0)) if self.connection.results else []
+        self.rowcount = len(self.rows)
+        return self.rowcount
+
+    def executemany(self, sql, args):
+        self.connection.executed.append((sql, args))
+        self.rowcount = len(args)
+        return self.rowcount
+
+    def nextset(self):
+        if not self.pending:
+            return None
+        self.pending.pop(0)
+        self._result()
+        return True
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, **config):
+        self.config = config
+        self.client_flag = config.get('client_flag', 0)
+        self.closed = False
+        self.broken = False
+        self.lastrowid = None
+        self.description = None
+        self.pings = 0
+        self.commits = 0
+        self.executed = []
+        self.results = []
+
+    def ping(self, reconnect=True):
+        self.pings += 1
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def begin(self):
+        self.executed.append('BEGIN')
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.executed.append('ROLLBACK')
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def make_pool(monkeypatch):
+    """``make_pool(config)``: the pool of the config with fake connections, reset after the test"""
+    monkeypatch.setattr(pymysql, 'connect', FakeConnection)
+    inited = []
+
+    def _make_pool(config):
+        db.ConnectionPool.init(config)
+        inited.append(True)
+        return db.ConnectionPool.instance()
+
+    yield _make_pool
+    if inited:
+        db.ConnectionPool._config = {}
+        db.ConnectionPool._default_db = db.DEFAULT_DB
+        del db.ConnectionPool._instance
+
+
+@pytest.fixture
+def pool(make_pool):
+    return make_pool({'default': {'MaxConnections': 2}})
+
+
+def test_acquire_release(pool):
+    conn1 = pool.acquire()
+    conn2 = pool.acquire()
+    assert conn1 is not conn2
+    assert pool.is_connection_using(conn1, 'default')
+    pool.release(conn1)
+    assert not pool.is_connection_using(conn1, 'default')
+    assert pool.acquire() is conn1
+    stats = pool.get_stats()
+    assert stats['using'] == 2 and stats['size'] == 2
+
+
+def test_acquire_timeout(pool):
+    pool.acquire()
+    pool.acquire()
+    with pytest.raises(db.PoolExhausted):
+        pool.acquire(timeout=0.05)
+    stats = pool.get_stats()
+    assert stats['timeouts'] == 1
+    assert stats['waiting'] == 0
+
+
+def test_waiters_are_fifo(pool):
+    conn1 = pool.acquire()
+    pool.acquire()
+    order = []
+
+    def _worker(i):
+        conn = pool.acquire(timeout=5)
+        order.append(i)
+        pool.release(conn)
+
+    threads = []
+    for i in range(3):
+        thread = threading.Thread(target=_worker, args=(i,))
+        thread.start()
+        threads.append(thread)
+        while pool.get_stats()['waiting'] <= i:
+            time.sleep(0.001)
+
+    pool.release(conn1)
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2]
+
+
+def test_ping_only_idle_connections(pool):
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert conn.pings == 1  # when connecting
+    pool.release(conn)
+    pool.get_state().ping_interval = 0
+    pool.acquire()
+    assert conn.pings == 2
+
+
+def test_retry_on_broken_connection(pool):
+    conn = pool.acquire()
+    conn.broken = True
+    pool.release(conn)
+    result = db.query('SELECT 1')
+    assert result is not None
+    assert conn.closed and conn.executed == ['SELECT 1']
+    assert pool.get_stats()['discarded'] == 1
+
+
+def test_no_retry_of_sent_writes(pool):
+    conn = pool.acquire()
+    conn.broken = 2013  # CR_SERVER_LOST: the server may have applied it
+    pool.release(conn)
+    assert db.execute('UPDATE `t` SET `n` = `n` + 1', auto_commit=True) is None
+    assert pool.get_stats()['discarded'] == 0
+
+    conn.broken = True  # CR_SERVER_GONE_ERROR: not sent
+    assert db.execute('UPDATE `t` SET `n` = `n` + 1', auto_commit=True) is not None
+    assert pool.get_stats()['discarded'] == 1
+
+
+def test_reap_idle(pool):
+    state = pool.get_state()
+    conn1, conn2 = pool.acquire(), pool.acquire()
+    pool.release(conn1)
+    pool.release(conn2)
+    state.idle_timeout = 60
+    state.infos[id(conn1)].released_at -= 120
+    pool.reap_idle('default')
+    assert conn1.closed and not conn2.closed
+    assert list(state.idle) == [conn2]
+
+    state.max_lifetime = 60
+    state.infos[id(conn2)].created_at -= 120
+    pool.reap_idle('default')
+    assert conn2.closed
+    assert len(state.idle) == state.min_idle == 1  # refilled
+    assert pool.get_stats()['retired'] == 2
+
+
+def test_aquery(pool):
+    conn = pool.acquire()
+    conn.results.append([{'id': 1}])
+    pool.release(conn)
+
+    async def _main():
+        return await db.aquery('SELECT `id` FROM `t`')
+
+    result = asyncio.run(_main())
+    assert result['rows'] == [{'id': 1}]
+
+
+class Item(db.BASE):
+    __fields__ = ('id', 'name')
+
+
+def test_iter_select(pool):
+    conn = pool.acquire()
+    conn.results.extend([[{'id': i} for i in range(5)]] * 2)
+    pool.release(conn)
+
+    rows = Item().iter_select(batch_size=2)
+    assert next(rows) == [{'id': 0}, {'id': 1}]
+    assert pool.is_connection_using(conn, 'default')
+    assert list(rows) == [[{'id': 2}, {'id': 3}], [{'id': 4}]]
+    assert not pool.is_connection_using(conn, 'default') and not conn.closed
+
+    rows = Item().iter_select()
+    assert next(rows) == {'id': 0}
+    rows.close()  # closed early: the connection is not reusable
+    assert conn.closed
+
+
+def test_select_after():
+    sql = statement.SQL('item', database='test')
+    assert sql.select_after('id', limit=10) == 'SELECT * FROM `test`.`item` WHERE 1 ORDER BY `id` LIMIT 10'
+    assert sql.select_after(['-a', '-b'], after=[1, 'x'], conditions={'c': 2}, limit=10) == (
+        "SELECT * FROM `test`.`item` WHERE (`c` = 2) AND (`a`, `b`) < (1, 'x') ORDER BY `a` DESC, `b` DESC LIMIT 10")
+
+
+def test_paginate(pool):
+    conn = pool.acquire()
+    conn.results.extend([[{'id': 1}, {'id': 2}], [{'id': 3}]])
+    pool.release(conn)
+
+    rows, cursor = Item().paginate(2, fields=['name'])
+    assert rows == [{'id': 1}, {'id': 2}] and cursor
+    rows, cursor = Item().paginate(2, cursor=cursor, fields=['name'])
+    assert rows == [{'id': 3}] and cursor is None
+    assert conn.executed[-1] == 'SELECT `name`, `id` FROM `default`.`item` WHERE 1 AND `id` > 2 ORDER BY `id` LIMIT 2'
+
+    values = [datetime.datetime(2020, 1, 2, 3, 4, 5, 678901), decimal.Decimal('12345678901234567890.123'), 'x', None]
+    assert db.decode_cursor(db.encode_cursor(values)) == values
+    with pytest.raises(TypeError):
+        db.encode_cursor([object()])
+
+    conn.broken = 1146
+    with pytest.raises(pymysql.err.OperationalError):  # not taken as the last page
+        Item().paginate(2)
+    conn.broken = False
+
+
+def test_insert_many_chunks(pool):
+    conn = pool.acquire()
+    pool.release(conn)
+    result = Item().insert_many(None, [(i, 'n%d' % i) for i in range(5)], max_rows=2)
+    assert len(conn.executed) == 3 and conn.commits == 3
+    assert conn.executed[-1] == "INSERT INTO `default`.`item` (`id`, `name`) VALUES (4, 'n4')"
+    assert result['lastrowids'] == [None] * 3 and result['errors'] == []
+
+    spans = []
+    trace.configure(exporter=spans.extend)
+    try:
+        with trace.request(sampled=True):
+            Item().insert_many(None, [(i, 'n%d' % i) for i in range(4)], max_rows=2, parallel=2)
+    finally:
+        trace.configure()
+    assert len([span for span in spans if span['name'] == 'execute']) == 2  # traced in the threads too
+
+
+def test_transaction(pool):
+    conn = pool.acquire()
+    pool.release(conn)
+    with db.transaction() as tx:
+        Item().update({'name': 'a'}, conditions={'id': 1})
+        Item().insert({'id': 2, 'name': 'b'})
+        assert pool.is_connection_using(conn, 'default')
+        assert db.Transaction.current('default') is tx
+    assert conn.commits == 1 and len(conn.executed) == 3
+    assert not pool.is_connection_using(conn, 'default')
+
+    with pytest.raises(ZeroDivisionError):
+        with db.transaction():
+            Item().delete(conditions={'id': 1})
+            1 / 0
+    assert conn.commits == 1 and conn.executed[-1] == 'ROLLBACK'
+
+
+class CachedItem(db.BASE):
+    __table__ = 'item'
+    __cache__ = {'ttl': 30, 'max_entries': 2}
+
+
+def test_query_cache(pool):
+    conn = pool.acquire()
+    conn.results.extend([[{'id': 1}], [], [{'id': 2}], [], [{'id': 3}]])
+    pool.release(conn)
+
+    rows = CachedItem().select(conditions={'id': 1})
+    rows[0]['id'] = 0  # the cached rows are not modified
+    assert CachedItem().select(conditions={'id': 1}) == [{'id': 1}]
+    assert len(conn.executed) == 1
+
+    Item().update({'name': 'a'}, conditions={'id': 1})  # any model of the table invalidates
+    assert CachedItem().select(conditions={'id': 1}) == [{'id': 2}]
+    CachedItem().update({'name': 'a'}, conditions={'id': 1})
+    assert CachedItem().select(conditions={'id': 1}) == [{'id': 3}]
+    assert len(conn.executed) == 5
+    assert (CachedItem().query_cache.hits, CachedItem().query_cache.misses) == (1, 3)
+
+    # the writes to the other tables read do not invalidate the cache, so it is bypassed
+    subquery = statement.SQL('order').subquery(['item_id'], {'paid': 1})
+    join = statement.Join(statement.SQL('order'), {'o.item_id': nodes.Column('i.id')}, 'o')
+    for _ in range(2):
+        CachedItem().select(conditions={'id__in': subquery})
+        CachedItem().select(['i.id'], alias='i', joins=[join])
+        CachedItem().count({'id__in': subquery})
+    assert len(conn.executed) == 11
+
+
+def test_row_formats():
+    description = (('id', 3), ('COUNT(1)', 8))
+    assert row_formats.format_rows(((1, 2),), description, 'tuple') == [(1, 2)]
+    row, = row_formats.format_rows(((1, 2),), description, 'namedtuple', 'ItemRow')
+    assert row.id == 1 and row._1 == 2 and row == (1, 2)
+    assert pickle.loads(pickle.dumps(row)) == row
+
+    row, = row_formats.format_rows(((1, 2),), description, 'slots', 'ItemRow')
+    assert row.id == 1 and tuple(row) == (1, 2) and not hasattr(row, '__dict__')
+    row.id = 3
+    assert pickle.loads(pickle.dumps(row)) == row
+    assert type(row) is row_formats.row_class('slots', 'ItemRow', ('id', 'COUNT(1)'))
+
+
+def test_columns_builder():
+    FIELD_TYPE = pymysql.constants.FIELD_TYPE
+    description = (('id', FIELD_TYPE.LONGLONG, None, 20, 20, 0, False),
+                   ('score', FIELD_TYPE.LONG, None, 11, 11, 0, True),
+                   ('name', FIELD_TYPE.VAR_STRING, None, 40, 40, 0, True))
+    builder = row_formats.ColumnsBuilder(description, use_numpy=False)
+    builder.extend([(1, 10, 'a'), (2, None, 'b')])
+    builder.extend([(2 ** 64 - 1, 30, None)])
+    columns = builder.build()
+    assert columns['id'] == [1, 2, 2 ** 64 - 1]  # overflowed, object
+    assert columns['score'].typecode == 'd' and columns['score'][0] == 10 and columns['score'][1] != columns['score'][1]
+    assert columns['name'] == ['a', 'b', None]
+
+    builder = row_formats.ColumnsBuilder(description[1:2], use_numpy=False)
+    builder.extend([(1,), (None,)])
+    builder.extend([(2 ** 60 + 1,)])
+    assert builder.build()['score'] == [1, None, 2 ** 60 + 1]  # not rounded in float64
+
+
+@pytest.fixture
+def replicated_pool(make_pool):
+    return make_pool({'default': {
+        'host': 'primary',
+        'Replicas': [{'host': 'replica0'}, {'host': 'replica1'}],
+        'ReadYourWrites': 10,
+    }})
+
+
+def test_read_replicas(replicated_pool):
+    def _acquired():
+        return [replicated_pool.get_stats(name)['acquired'] for name in ('default', 'default:replica0',
+                                                                        'default:replica1')]
+
+    db.query('SELECT 1')
+    assert _acquired() == [0, 1, 0]
+    with db.transaction():
+        db.query('SELECT 1')
+    assert _acquired() == [1, 1, 0]
+    Item().select()
+    assert _acquired() == [1, 1, 1]
+
+    assert db.read_db() == 'default:replica0'
+    Item().delete(conditions={'id': 1})
+    assert db.read_db() == 'default'  # read your writes
+
+
+def test_read_after_write(replicated_pool):
+    def _parallel_insert():
+        assert db.read_db() != 'default'
+        Item().insert_many(None, [(1, 'a'), (2, 'b')], max_rows=1, parallel=2)
+        return db.read_db()
+
+    assert contextvars.Context().run(_parallel_insert) == 'default'  # marked in the caller context
+
+    async def _ainsert():
+        assert db.read_db() != 'default'
+        await Item().ainsert({'id': 3, 'name': 'c'})
+        return db.read_db()
+
+    assert contextvars.Context().run(asyncio.run, _ainsert()) == 'default'
+
+    replicated_pool._read_policies['default'] = (replicated_pool._read_policies['default'][0], 0)
+    conn = replicated_pool.acquire()
+    conn.lastrowid = 7
+    conn.results.extend([[], [{'id': 7, 'name': 'd'}]])
+    replicated_pool.release(conn)
+    assert contextvars.Context().run(Item().insert, {'name': 'd'}, refetch=True) == {'id': 7, 'name': 'd'}
+    assert conn.executed[-1] == 'SELECT * FROM `default`.`item` WHERE (`id` = 7) LIMIT 1'  # on the primary
+
+
+def test_shard_routers():
+    shards = ('s0', 's1', 's2')
+    assert shard.ModuloRouter()(4, shards) == 's1'
+    assert shard.RangeRouter([(100, 's0'), (200, 's1'), (None, 's2')])(150, shards) == 's1'
+    router = shard.ConsistentHashRouter()
+    assert router('user:1', shards) == router('user:1', shards) in shards
+    moved = sum(router(i, shards) != router(i, shards + ('s3',)) for i in range(1000))
+    assert moved < 400
+
+
+class ShardedItem(db.BASE):
+    __table__ = 'item'
+    __shard_key__ = 'user_id'
+    __shards__ = ('s0', 's1')
+
+
+@pytest.fixture
+def sharded_pool(make_pool):
+    return make_pool({'s0': {'MaxConnections': 1}, 's1': {'MaxConnections': 1}})
+
+
+def test_sharded_select(sharded_pool):
+    conns = []
+    for name, rows in (('s0', [{'id': 1, 'user_id': 2}, {'id': 4, 'user_id': 4}]), ('s1', [{'id': 3, 'user_id': 1}])):
+        conn = sharded_pool.acquire(name)
+        conn.results.extend([rows, rows])
+        sharded_pool.release(conn, name)
+        conns.append(conn)
+
+    ShardedItem().select(conditions={'user_id': 3})
+    assert conns[1].executed == ["SELECT * FROM `s1`.`item` WHERE (`user_id` = 3)"] and conns[0].executed == []
+
+    rows = ShardedItem().select(order_by='-id', limit=2, offset=1)
+    assert conns[0].executed[-1] == 'SELECT * FROM `s0`.`item` WHERE 1 ORDER BY `id` DESC LIMIT 3'
+    assert rows == [{'id': 3, 'user_id': 1}, {'id': 1, 'user_id': 2}]
+
+    for conn, rows in zip(conns, ([('a', 1), ('d', 4)], [('c', 3)])):
+        conn.description = (('name',), ('id',))
+        conn.results[:] = [rows]
+    rows = ShardedItem().select(['name'], order_by='-id', row_format='tuple')
+    assert conns[0].executed[-1] == 'SELECT `name`, `id` FROM `s0`.`item` WHERE 1 ORDER BY `id` DESC'
+    assert rows == [('d',), ('c',), ('a',)]
+
+
+class CachedShardedItem(db.BASE):
+    __table__ = 'item'
+    __shard_key__ = 'user_id'
+    __shards__ = ('s0', 's1')
+    __cache__ = True
+
+
+def test_sharded_query_cache(make_pool):
+    make_pool({'s0': {'database': 'app'}, 's1': {'database': 'app'}})  # on different hosts
+    pool = db.ConnectionPool.instance()
+    conns = []
+    for name, rows in (('s0', [{'id': 1, 'user_id': 2}]), ('s1', [{'id': 2, 'user_id': 1}])):
+        conn = pool.acquire(name)
+        conn.results.extend([rows, [], rows])
+        pool.release(conn, name)
+        conns.append(conn)
+
+    for _ in range(2):
+        rows = CachedShardedItem().select(conditions={'status': 1}, order_by='id')
+        assert rows == [{'id': 1, 'user_id': 2}, {'id': 2, 'user_id': 1}]
+    assert [len(conn.executed) for conn in conns] == [1, 1]  # the same SQL, cached for each shard
+
+    CachedShardedItem().update({'status': 2}, conditions={'user_id': 1})  # on s1
+    CachedShardedItem().select(conditions={'status': 1}, order_by='id')
+    assert [len(conn.executed) for conn in conns] == [1, 3]
+
+
+def test_fingerprint():
+    assert stats.fingerprint("SELECT * FROM `t1` WHERE (`a` = 1 AND `b` IN ('x', 'y\\'z'))") == \
+        'SELECT * FROM `t1` WHERE (`a` = ? AND `b` IN (?+))'
+    assert stats.fingerprint("INSERT INTO `t` (`a`, `b`) VALUES (1, 'x'), (2, 'y'), (-3.5, 'z')") == \
+        'INSERT INTO `t` (`a`, `b`) VALUES (?+), ...'
+
+
+def test_statement_stats(pool):
+    stats.STATS.reset()
+    stats.enable()
+    try:
+        for i in range(3):
+            db.query('SELECT * FROM `t` WHERE `id` = %d' % i)
+    finally:
+        stats.disable()
+    entry = stats.STATS.get('SELECT * FROM `t` WHERE `id` = 100')
+    assert entry['calls'] == 3 and entry['errors'] == 0
+    assert '"calls": 3' in stats.STATS.dump_json()
+
+
+def test_trace(pool, tmp_path):
+    path = str(tmp_path / 'spans.jsonl')
+    trace.configure(sample_rate=0.0, path=path)
+    with trace.request('not-sampled') as tracing:
+        assert tracing is None and trace.current() is None
+        db.query('SELECT 1')
+
+    with trace.request('r1', sampled=True) as tracing:
+        db.execute('UPDATE `t` SET `a` = 1', auto_commit=True)
+        db.query('SELECT 1')
+        names = [span['name'] for span in tracing.spans]
+    assert trace.current() is None
+    assert names == ['acquire', 'execute', 'commit', 'acquire', 'execute', 'fetch', 'commit']
+    with open(path) as _file:
+        spans = [json.loads(line) for line in _file]
+    assert len(spans) == 7 and all(span['request_id'] == 'r1' for span in spans)
+    assert spans[1]['sql'] == 'UPDATE `t` SET `a` = 1'
+    trace.configure()
+
+
+def test_coalesce_reads(pool, monkeypatch):
+    calls = []
+    started = threading.Event()
+    finish = threading.Event()
+
+    def _execute(sql, **kwargs):
+        calls.append(sql)
+        started.set()
+        finish.wait(5)
+        return {'rows': [{'id': 1}]}
+
+    monkeypatch.setattr(db, '_execute', _execute)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(db.query('SELECT 1', coalesce=True))) for _ in range(3)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while pool.get_stats()['coalesced'] < 2:
+        time.sleep(0.001)
+    finish.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ['SELECT 1']
+    rows = [result['rows'][0] for result in results]
+    assert rows == [{'id': 1}] * 3 and len(set(id(row) for row in rows)) == 3
+    assert db.query('SELECT 1') == {'rows': [{'id': 1}]} and len(calls) == 2
+
+    # the leader modifying its result at once, while the waiting callers copy theirs
+    started.clear()
+    finish.clear()
+
+    def _fetch():
+        started.set()
+        finish.wait(5)
+        return {'id': 1}
+
+    def _slow_copy(result):
+        time.sleep(0.01)
+        return dict(result)
+
+    def _lead():
+        pool.coalesce('default', 'k', _fetch, share=_slow_copy)['id'] = 'mutated by leader'
+
+    followed = []
+    leader = threading.Thread(target=_lead)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: followed.append(pool.coalesce('default', 'k', _fetch,
+                                                                               share=_slow_copy)))
+                 for _ in range(2)]
+    for thread in followers:
+        thread.start()
+    while pool.get_stats()['coalesced'] < 4:
+        time.sleep(0.001)
+    finish.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert followed == [{'id': 1}, {'id': 1}]
+
+
+def test_batch(pool):
+    conn = pool.acquire()
+    conn.results.extend([[None], [], [None, None]])
+    pool.release(conn)
+    with db.batch() as batch:
+        for i in range(3):
+            batch.add('UPDATE `t` SET `a` = %d' % i)
+    assert batch.rowcounts == [1, 0, 2]
+    assert conn.executed == ['BEGIN'] + ['UPDATE `t` SET `a` = %d' % i for i in range(3)]
+    assert conn.commits == 1
+
+    conn.client_flag = CLIENT.MULTI_STATEMENTS
+    conn.results.extend([[None], [None, None], []])
+    batch = db.batch(max_bytes=50)
+    for i in range(3):
+        batch.add('UPDATE `t` SET `a` = %d' % i)
+    assert batch.execute() == [1, 2, 0]
+    assert conn.executed[-2:] == ['UPDATE `t` SET `a` = 0;\nUPDATE `t` SET `a` = 1', 'UPDATE `t` SET `a` = 2']
+    assert conn.commits == 2
+
+    batch = db.batch(max_bytes=60)  # 56 characters, 64 bytes in UTF-8
+    batch.add("UPDATE `t` SET `a` = '中文'")
+    batch.add("UPDATE `t` SET `b` = '中文'")
+    batch.execute()
+    assert conn.executed[-2:] == ["UPDATE `t` SET `a` = '中文'", "UPDATE `t` SET `b` = '中文'"]
+
+
+class ParamItem(db.BASE):
+    __table__ = 'item'
+    __parameterized__ = True
+
+
+def test_parameterized(pool):
+    sql = statement.SQL('t', parameterized=True)
+    assert sql.select(conditions={'a': 1, 'b__in': [2, 3], 'c__like': 'x', 'd': None}, limit=1) == (
+        'SELECT * FROM `t` WHERE (`a` = %s AND `b` IN (%s,%s) AND `c` LIKE %s AND `d` IS NULL) LIMIT %s',
+        [1, 2, 3, '%x%', 1])
+    assert sql.update({'ADD:n': 1}, 'name LIKE "%a"') == (
+        'UPDATE `t` SET `n` = `n` + %s WHERE name LIKE "%%a"', [1])
+    assert nodes.literal(*sql.delete({'a': "'"})) == statement.SQL('t').delete({'a': "'"})
+
+    conn = pool.acquire()
+    conn.results.append([{'id': 1}])
+    pool.release(conn)
+    assert ParamItem().get(1) == {'id': 1}
+    assert conn.executed[-1] == ('SELECT * FROM `default`.`item` WHERE (`id` = %s) LIMIT %s', [1, 1])
+
+    result = ParamItem().insert_many(['a', 'b'], [(1, 2), (3, 4), (5, 6)], max_rows=2)
+    assert result['rowcount'] == 3
+    assert conn.executed[-2:] == [('INSERT INTO `default`.`item` (`a`, `b`) VALUES (%s, %s)', [(1, 2), (3, 4)]),
+                                  ('INSERT INTO `default`.`item` (`a`, `b`) VALUES (%s, %s)', [(5, 6)])]
+
+
+def test_compiled_templates(monkeypatch):
+    monkeypatch.setattr(statement, '_templates', collections.OrderedDict())
+    sql = statement.SQL('t')
+    assert sql.select(conditions={'a': 1, 'b__in': [1, 2]}, limit=10) == \
+        'SELECT * FROM `t` WHERE (`a` = 1 AND `b` IN (1,2)) LIMIT 10'
+    monkeypatch.setattr(statement, 'make_tree', None)  # the templates are not built again
+    assert sql.select(conditions={'a': "'", 'b__in': [3, 4]}, limit=5) == \
+        "SELECT * FROM `t` WHERE (`a` = '\\'' AND `b` IN (3,4)) LIMIT 5"
+    assert len(statement._templates) == 1
+    with pytest.raises(TypeError):
+        sql.select(conditions={'a': 1, 'b__in': [1, 2, 3]})  # another shape
+
+    monkeypatch.setattr(statement, 'make_tree', nodes.make_tree)
+    assert sql.insert([1], ['a'], mode='replace', update={'a': 2}) == 'REPLACE INTO `t` (`a`) VALUES (1)'
+    expected = {None: 'SELECT * FROM `t` WHERE (`deleted__is_null` IS NULL)',
+                True: 'SELECT * FROM `t` WHERE (`deleted` IS NULL)'}
+    for order in ([None, True], [True, None]):  # same key, different fields
+        statement._templates.clear()
+        for value in order:
+            assert sql.select(conditions={'deleted__is_null': value}) == expected[value]
+
+    monkeypatch.setattr(statement, 'TEMPLATES_CACHE_SIZE', 2)
+    statement._templates.clear()
+    built = []
+    monkeypatch.setattr(statement, 'make_tree', lambda conditions, *args: built.append(conditions) or
+                        nodes.make_tree(conditions, *args))
+    for i in range(1, 4):  # IN lists of other lengths do not evict the hot shape
+        sql.select(conditions={'a': 1})
+        sql.select(conditions={'b__in': list(range(i))})
+    assert len(statement._templates) == 2 and built.count({'a': 1}) == 1
+
+
+class ChunkedItem(db.BASE):
+    __table__ = 'item'
+    __in_chunk_size__ = 2
+    __in_parallel__ = 1
+
+
+def test_large_in(pool):
+    conn = pool.acquire()
+    conn.results.extend([[{'id': 5}, {'id': 1}], [{'id': 2}], [(3,)], [(1,)]])
+    pool.release(conn)
+    rows = ChunkedItem().select(conditions={'id': [5, 1, 2, 2, 3], 'a': 0}, order_by='id', limit=2)
+    assert conn.executed == ['SELECT * FROM `default`.`item` WHERE (`id` IN (5,1) AND `a` = 0) ORDER BY `id` LIMIT 2',
+                             'SELECT * FROM `default`.`item` WHERE (`id` IN (2,3) AND `a` = 0) ORDER BY `id` LIMIT 2']
+    assert rows == [{'id': 1}, {'id': 2}]
+    assert ChunkedItem().count({'id__in': [1, 2, 3]}) == 4
+
+    # the order by columns are selected for the merging, not returned
+    conn.results.extend([[{'name': 'e', 'id': 5}, {'name': 'a', 'id': 1}], [{'name': 'b', 'id': 2}]])
+    assert ChunkedItem().select(['name'], {'id': [5, 1, 2]}, order_by='-id') == [{'name': 'e'}, {'name': 'b'},
+                                                                                 {'name': 'a'}]
+    assert conn.executed[-1] == 'SELECT `name`, `id` FROM `default`.`item` WHERE (`id` IN (2)) ORDER BY `id` DESC'
+    conn.results.extend([[{'n': 'a'}, {'n': 'c'}], [{'n': 'b'}]])
+    assert ChunkedItem().select([('name', 'n')], {'id': [5, 1, 2]}, order_by='n') == [{'n': 'a'}, {'n': 'b'},
+                                                                                      {'n': 'c'}]
+    assert conn.executed[-1] == 'SELECT `name` AS `n` FROM `default`.`item` WHERE (`id` IN (2)) ORDER BY `n`'
+    conn.description = (('name',), ('id',))
+    conn.results.extend([[('e', 5), ('a', 1)], [('b', 2)]])
+    assert ChunkedItem().select(['name'], {'id': [5, 1, 2]}, order_by='-id', row_format='tuple') == [
+        ('e',), ('b',), ('a',)]
+    conn.description = None
+
+    ChunkedItem().select(['i.id'], {'i.id': [5, 1, 2]}, alias='i')
+    assert conn.executed[-1] == 'SELECT `i`.`id` FROM `default`.`item` AS `i` WHERE (`i`.`id` IN (2))'
+
+    ChunkedItem.__in_temp_table_size__ = 3
+    try:
+        ChunkedItem().select(['i.id'], {'i.id': [1, 2, 3]}, alias='i')
+        assert conn.executed[-2] == ('SELECT `i`.`id` FROM `default`.`item` AS `i` '
+                                     'WHERE `i`.`id` IN (SELECT `k` FROM `_lian_in_keys`)')
+        conn.results.extend([[], [], [], [{'id': 1}]])
+        assert ChunkedItem().select(conditions={'id': [1, 2, 3]}) == [{'id': 1}]
+    finally:
+        del ChunkedItem.__in_temp_table_size__
+    assert conn.executed[-6:] == [
+        'BEGIN',
+        'DROP TEMPORARY TABLE IF EXISTS `_lian_in_keys`',
+        'CREATE TEMPORARY TABLE `_lian_in_keys` (`k` BIGINT PRIMARY KEY)',
+        'INSERT INTO `_lian_in_keys` (`k`) VALUES (1), (2), (3)',
+        'SELECT * FROM `default`.`item` WHERE `id` IN (SELECT `k` FROM `_lian_in_keys`)',
+        'DROP TEMPORARY TABLE IF EXISTS `_lian_in_keys`',
+    ]
+
+
+def test_model_meta(make_pool):
+    import logging
+    logger = logging.getLogger('test.items')
+    make_pool({'items': {'database': 'real_items', 'Logger': logger}})
+
+    class Items(db.BASE):
+        __database__ = 'items'
+
+    item1, item2 = Items(), Items()
+    assert item1.sql is item2.sql and item1.sql.sql_table == '`real_items`.`items`'
+    assert item1.full_table_name == 'real_items.items'
+    assert item1.logger is logger  # of the db config, not of the real database name
+
+
+def test_find_and_exists(pool):
+    conn = pool.acquire()
+    conn.results.extend([[{'id': 2}], [], [(1,)], [(0,)]])
+    pool.release(conn)
+    assert Item().first_or_none({'a': 1}, order_by='-id') == {'id': 2}
+    assert Item().find(conditions={'a': 2}) is None
+    assert Item().exists({'a': 1}) is True
+    assert Item().exists({'a': 2}) is False
+    assert conn.executed == [
+        'SELECT * FROM `default`.`item` WHERE (`a` = 1) ORDER BY `id` DESC LIMIT 1',
+        'SELECT * FROM `default`.`item` WHERE (`a` = 2) LIMIT 1',
+        'SELECT EXISTS(SELECT 1 FROM `default`.`item` WHERE (`a` = 1))',
+        'SELECT EXISTS(SELECT 1 FROM `default`.`item` WHERE (`a` = 2))',
+    ]
+
+
+def test_join_and_subquery():
+    users, orders = statement.SQL('user', 'db'), statement.SQL('order', 'db')
+    paid = orders.subquery(['user_id'], {'paid': 1, 'note__like': '%'})
+    assert users.select(['u.id', ('SUM:o.amount', 'amount')], {'u.id__in': paid, 'u.name': 'x'},
+                        order_by='-u.id', group_by='u.id', alias='u',
+                        joins=[statement.Join(orders, {'o.user_id': statement.Column('u.id')}, 'o', 'left')]) == (
+        "SELECT `u`.`id`, SUM(`o`.`amount`) AS `amount` FROM `db`.`user` AS `u` "
+        "LEFT JOIN `db`.`order` AS `o` ON (`o`.`user_id` = `u`.`id`) "
+        "WHERE (`u`.`id` IN (SELECT `user_id` FROM `db`.`order` WHERE (`paid` = 1 AND `note` LIKE '%%%')) "
+        "AND `u`.`name` = 'x') GROUP BY `u`.`id` ORDER BY `u`.`id` DESC")
+
+    users = statement.SQL('user', 'db', parameterized=True)
+    assert users.select(conditions={'id__in': paid, 'status': 2}, limit=1) == (
+        'SELECT * FROM `db`.`user` WHERE (`id` IN (SELECT `user_id` FROM `db`.`order` '
+        'WHERE (`paid` = %s AND `note` LIKE %s)) AND `status` = %s) LIMIT %s', [1, '%%%', 2, 1])
+
+
+def test_loader(pool):
+    conn = pool.acquire()
+    conn.results.extend([[{'id': 1}], [], [{'id': 1}], [], [{'id': 2}, {'id': 3}], [{'id': 4}, {'id': 5}]])
+    pool.release(conn)
+    with loader.request():
+        row = Item().get(1)
+        assert Item().get(1) is row  # from the identity map
+        Item().update({'name': 'x'}, {'id': 1})
+        assert Item().get(1) is not row
+        with pytest.raises(db.ObjectNotFound):
+            Item().get(6)  # the miss is kept too
+
+        async def _gather():
+            return await asyncio.gather(Item().aget(2), Item().aget(3), Item().aget(2))
+
+        assert asyncio.run(_gather()) == [{'id': 2}, {'id': 3}, {'id': 2}]
+
+    with loader.request(window=0.05):
+        results = {}
+        threads = [threading.Thread(target=contextvars.copy_context().run,
+                                    args=(lambda pk: results.update({pk: Item().get(pk)}), pk)) for pk in (4, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {4: {'id': 4}, 5: {'id': 5}}
+
+    selects = [sql for sql in conn.executed if sql.startswith('SELECT')]
+    assert selects[0] == 'SELECT * FROM `default`.`item` WHERE (`id` IN (1))'
+    assert selects[2] == 'SELECT * FROM `default`.`item` WHERE (`id` IN (6))'
+    assert selects[3] == 'SELECT * FROM `default`.`item` WHERE (`id` IN (2,3))'
+    assert selects[4] in ('SELECT * FROM `default`.`item` WHERE (`id` IN (4,5))',
+                          'SELECT * FROM `default`.`item` WHERE (`id` IN (5,4))')
+    assert len(selects) == 5
+
+    with loader.request():
+        conn.broken = 1146  # not a connection error, not retried
+        with pytest.raises(pymysql.err.OperationalError):
+            Item().get(7)
+        conn.broken = False
+        conn.results.append([{'id': 7}])
+        assert Item().get(7) == {'id': 7}  # the failed batch was not kept as not found
+
+
+def test_update_many(pool):
+    conn = pool.acquire()
+    conn.results.extend([[None] * 2, [None]])
+    pool.release(conn)
+    rows = [{'id': 1, 'name': 'a', 'n': 1}, {'id': 2, 'name': "b'", 'n': 2}, {'id': 1, 'name': 'c', 'n': 3}]
+    assert Item().update_many(rows + [{'id': 3, 'name': 'd', 'n': 4}], max_rows=2) == 3
+    assert conn.executed == [
+        "UPDATE `default`.`item` SET `name` = CASE `id` WHEN 1 THEN 'c' WHEN 2 THEN 'b\\'' END, "
+        "`n` = CASE `id` WHEN 1 THEN 3 WHEN 2 THEN 2 END WHERE `id` IN (1,2)",
+        "UPDATE `default`.`item` SET `name` = CASE `id` WHEN 3 THEN 'd' END, `n` = CASE `id` WHEN 3 THEN 4 END "
+        "WHERE `id` IN (3)",
+    ]
+    assert conn.commits == 2
+
+    async def _update():
+        return await ParamItem().aupdate_many(rows, fields=['n'])
+
+    asyncio.run(_update())
+    assert conn.executed[-1] == (
+        'UPDATE `default`.`item` SET `n` = CASE `id` WHEN %s THEN %s WHEN %s THEN %s END WHERE `id` IN (%s,%s)',
+        [1, 3, 2, 2, 1, 2])
+
+    with loader.request():
+        conn.results.extend([[{'id': 1}], [{'id': 1}]])
+        row = Item().get(1)
+        conn.broken = 1146
+        with pytest.raises(pymysql.err.OperationalError):
+            Item().update_many(rows)
+        conn.broken = False
+        assert Item().get(1) is not row  # invalidated even if failed
+
+
+def test_update_many_shards(sharded_pool):
+    conns = [sharded_pool.acquire(name) for name in ('s0', 's1')]
+    for name, conn in zip(('s0', 's1'), conns):
+        sharded_pool.release(conn, name)
+    ShardedItem().update_many([{'id': 1, 'user_id': 2, 'n': 1}, {'id': 2, 'user_id': 3, 'n': 2}], fields=['n'])
+    assert conns[0].executed == ["UPDATE `s0`.`item` SET `n` = CASE `id` WHEN 1 THEN 1 END WHERE `id` IN (1)"]
+    assert conns[1].executed == ["UPDATE `s1`.`item` SET `n` = CASE `id` WHEN 2 THEN 2 END WHERE `id` IN (2)"]